@@ -1,3 +1,5 @@
+import datetime
+
 from typing import List, Type
 
 from rules.rules import *
@@ -12,6 +14,7 @@ from rules.drawing_rules import *
 from utility.online import *
 from structures.structures import *
 from rules.network_rules import *
+from utility.effect_flow import narrow_watches
 
 DRAWING_RULES: List[Rule] = [DrawInitRule(), RedrawRule(), MarkRule(), SelectRule(), MarkCMAPRule(), DrawPieceRule(),
                              DrawPieceCMAPRule()]
@@ -109,16 +112,23 @@ def setup_chess(config: dict, start_positions: str, special: List[Rule], piece_m
             ruleset.add_rule(rule, 0)
 
     online = config.get("online", False)
+    recorder = None
     if not online and config.get("playback", ""):  # load game from playback
         ruleset.add_rule(PlaybackRule(chess, config["playback"], move0), 0)
     elif config.get("record", False):  # record playback
-        ruleset.add_rule(RecordRule())
+        recorder = GameRecorder(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S.chs"))
 
     chess.load_board_str(start_positions)  # load starting board
 
+    if recorder is not None:  # only what happens after the start position
+        recorder.begin(config.get("variant", "chess"), start_positions)
+        ruleset.add_rule(recorder)
+
     if online:  # enable online functionality
         make_online(chess, [move1, "exit", "take", "create_piece"])
 
+    narrow_watches(ruleset)  # the network rules declare their effects, no need for them to see every effect
+
     ruleset.process("init", ())
 
     tkchess.geometry("600x600")
@@ -140,7 +150,7 @@ def play_chess(online=True, playback="", record=True):
     start = "wa8Th8Tb8Pg8Pc8Lf8Ld8De8Ka7pb7pc7pd7pe7pf7pg7ph7p;" \
             "ba1Th1Tb1Pg1Pc1Lf1Ld1De1Ka2pb2pc2pd2pe2pf2pg2ph2p"
 
-    cfg = {"online": online, "playback": playback, "record": record, "show_valid": []}
+    cfg = {"variant": "chess", "online": online, "playback": playback, "record": record, "show_valid": []}
 
     chess, tkchess = setup_chess(cfg, start, special, move_rules, post_move, additional)
     tkchess.mainloop()  # start the game
@@ -160,7 +170,7 @@ def play_fairy(online=True, playback="", record=True):
     start = "wa8Sh8Sb8Jg8Jc8Cf8Cd8We8Ka7Fb7Fc7Fd7Fe7Ff7Fg7Fh7F;" \
             "ba1Sh1Sb1Jg1Jc1Cf1Cd1We1Ka2Fb2Fc2Fd2Fe2Ff2Fg2Fh2F"
 
-    cfg = {"online": online, "playback": playback, "record": record, "show_valid": []}
+    cfg = {"variant": "fairy", "online": online, "playback": playback, "record": record, "show_valid": []}
 
     chess, tkchess = setup_chess(cfg, start, special, move_rules, post_move, additional)
     tkchess.mainloop()  # start the game
@@ -181,7 +191,8 @@ def play_los(online=True, playback="", record=True):
     start = "wa8Sh8Sb8Jg8Jc8Cf8Cd8We8Ka7Fb7Fc7Fd7Fe7Ff7Fg7Fh7F;" \
             "ba1Sh1Sb1Jg1Jc1Cf1Cd1We1Ka2Fb2Fc2Fd2Fe2Ff2Fg2Fh2F"
 
-    cfg = {"online": online, "playback": playback, "record": record, "show_valid": show_valid}
+    cfg = {"variant": "los", "online": online, "playback": playback, "record": record,
+           "show_valid": show_valid}
 
     chess, tkchess = setup_chess(cfg, start, special, move_rules, post_move, additional)
     tkchess.mainloop()  # start the game
@@ -9,6 +9,8 @@ from structures.chess_structures import *
 
 
 class TouchMoveRule(Rule):
+    state_attrs = ["prev"]
+
     def __init__(self, consequence: str, cause: str = "touch"):
         Rule.__init__(self, watch=[cause])
 
@@ -202,6 +204,8 @@ class MoveRedrawRule(Rule):
 
 
 class NextTurnRule(Rule):
+    state_attrs = ["num"]
+
     def __init__(self):
         Rule.__init__(self, watch=["start_turn", "end_turn"])
 
@@ -307,46 +311,150 @@ class SetPlayerRule(Rule):
             print("you are playing as:", args)
 
 
-class RecordRule(Rule):
-    def __init__(self):
-        Rule.__init__(self, watch=["moved", "exit"])
+class GameRecorder(Rule):  # streams the game to fn as json lines, a header and then one record per board change
+    state_attrs = ["turn"]
 
-        self.start = datetime.datetime.now()
-        self.log = []
+    def __init__(self, fn: str, offset: int = None):
+        Rule.__init__(self, watch=["start_turn", "moved", "take", "create_piece", "turn_changed", "exit", "stop"])
+
+        self.fn = fn
+        self.turn = 0  # castling moves the rook after the turn has already been passed on
+        self.resumed = offset is not None
+
+        if self.resumed:  # carry on from a point saved earlier, dropping whatever was written after it
+            self.file = open(fn, mode="r+")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(fn, mode="w")
+
+        self.end = 0
+
+    def begin(self, variant: str, start: str, players: Dict[str, str] = None):  # after the start position is set up
+        if not self.resumed:
+            self.write({"variant": variant, "start": start, "players": players or {},
+                        "date": datetime.datetime.now().isoformat(timespec="seconds")})
+            self.flush()
+
+    def join(self, player: str, col: str):
+        self.write(["p", None, player, col])
+        self.flush()
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def flush(self):  # at the end of every turn, a game that sits idle has nothing left in the buffer
+        if self.file is not None:
+            self.file.flush()
+
+    def position(self):  # everything before this offset is written, see offset
+        self.flush()
+        return self.file.tell() if self.file is not None else self.end
+
+    def close(self):
+        if self.file is not None:
+            self.end = self.file.tell()
+            self.file.close()
+            self.file = None
 
     def process(self, game: Chess, effect: str, args):
-        if effect == "moved":
+        turn = self.turn
+
+        if effect == "start_turn":
+            self.turn = args
+        elif effect == "moved":
             piece_id, start, end = args
+            if start != end:
+                self.write(["m", turn, start, end])
+        elif effect == "take":
+            self.write(["t", turn, args])
+        elif effect == "create_piece":
+            pos, col, shape = args
+            self.write(["c", turn, pos, col, shape])
+        elif effect == "turn_changed":
+            self.flush()
+        elif effect in ["exit", "stop"]:
+            self.close()
+
+
+def read_record(fn: str):  # (header, records) of a game written by GameRecorder
+    with open(fn, mode="r") as f:
+        header = json.loads(f.readline())
 
-            self.log += [(start, end)]
-        elif effect == "exit":
-            fn = self.start.strftime("%Y_%m_%d_%H_%M_%S.chs")
+        if isinstance(header, list):  # written by the old RecordRule: one json list of (start, end), nothing else
+            records = [["m", i + 1, start, end] for i, (start, end) in enumerate(header)]
+            return {"variant": None, "start": None, "players": {}, "date": None, "moves_only": True}, records
 
-            with open(fn, mode="w") as f:
-                json.dump(self.log, f)
+        records = []
 
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # cut short by a crash
 
-class PlaybackRule(Rule):
-    def __init__(self, game: Chess, fn: str, move0: str):
-        Rule.__init__(self)
+    return header, records
+
+
+class PlaybackRule(Rule):  # steps through a recorded game one turn at a time, straight onto the board
+    def __init__(self, game: Chess, fn: str, move0: str = None):
+        Rule.__init__(self, watch=[])
 
         game.tkchess.bind("<Return>", self.step)
 
-        self.move0 = move0
+        self.consumes = []
+        self.emits = []
+
+        self.move0 = move0  # old recordings only have the moves, they are played through the move rules again
         self.ruleset = game.ruleset
         self.i = 0
 
-        with open(fn, mode="r") as f:
-            self.log = json.load(f)
+        self.header, log = read_record(fn)
+        self.players = dict(self.header["players"])
+        self.log = []
+
+        for record in log:
+            if record[0] == "p":
+                self.players[record[2]] = record[3]
+            else:
+                self.log.append(record)
 
     def step(self, event=None):
         if self.i == len(self.log):
             return
 
-        move = self.log[self.i]
-        self.i += 1
+        if self.header.get("moves_only"):
+            _, _, start, end = self.log[self.i]
+            self.i += 1
+
+            game = self.ruleset.game
+            self.ruleset.process("start_turn", game.get_turn_num())
+            self.ruleset.process(self.move0, (tuple(start), tuple(end), game.get_turn()))
+            return
+
+        game = self.ruleset.game
+        turn = self.log[self.i][1]
+        self.ruleset.process("start_turn", turn)
+
+        while self.i < len(self.log) and self.log[self.i][1] == turn:
+            kind, _, *args = self.log[self.i]
+            self.i += 1
+
+            if kind == "m":
+                start, end = args
+                piece_id = game.get_id(game.get_board().get_piece(start))
+
+                self.ruleset.process("set_piece", (tuple(end), piece_id))
+                self.ruleset.process("set_piece", (tuple(start), game.get_id(None)))
+            elif kind == "t":
+                self.ruleset.process("take", tuple(args[0]))
+            elif kind == "c":
+                pos, col, shape = args
+                self.ruleset.process("create_piece", (tuple(pos), col, shape))
 
-        self.ruleset.process(self.move0, move)
+        self.ruleset.process("end_turn", turn)
+        self.ruleset.process("redraw", ())
 
     def process(self, game: Game, effect: str, args):
         ...
@@ -364,5 +472,5 @@ class ExitRule(Rule):
 
 __all__ = ['TouchMoveRule', 'IdMoveRule', 'MoveTurnRule', 'MovePlayerRule', 'FriendlyFireRule', 'SuccesfulMoveRule',
            'MoveTakeRule', 'TakeRule', 'CreatePieceRule', 'SetPieceRule', 'MoveRedrawRule', 'NextTurnRule',
-           'MovedRule', 'CounterRule', 'WinRule', 'WinMessageRule', 'WinCloseRule', 'SetPlayerRule', 'RecordRule',
-           'PlaybackRule', 'ExitRule', 'TouchStartsTurnRule']
+           'MovedRule', 'CounterRule', 'WinRule', 'WinMessageRule', 'WinCloseRule', 'SetPlayerRule', 'GameRecorder',
+           'read_record', 'PlaybackRule', 'ExitRule', 'TouchStartsTurnRule']
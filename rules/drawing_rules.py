@@ -20,6 +20,17 @@ def fill_opaque(arr, col):
     return out
 
 
+def piece_look(piece, table=None):  # (shape, colour) as drawn by the web client
+    if not piece:
+        return "", ""
+
+    shape, col = piece.shape, piece.get_colour()
+    if table:
+        shape = table.get(shape, shape)
+
+    return shape, DrawPieceCMAPRule.cmap.get(col, col)
+
+
 def hex_to_rgb(value):
     value = value.lstrip('#')
     lv = len(value)
@@ -299,4 +310,4 @@ class MarkRule(Rule):
 
 
 __all__ = ['DrawInitRule', 'RedrawRule', 'SelectRule', 'fill_opaque', 'DrawPieceRule', 'MarkCMAPRule', 'hex_to_rgb',
-           'MarkRule', 'DrawSetPieceRule', 'DrawPieceCMAPRule', 'MarkValidRule']
+           'MarkRule', 'DrawSetPieceRule', 'DrawPieceCMAPRule', 'MarkValidRule', 'piece_look']
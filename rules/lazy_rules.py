@@ -3,6 +3,9 @@ from structures.lazy_structures import *
 
 
 class SetPieceRuleL(Rule):
+    consumes = ["set_piece"]
+    emits = ["piece_set"]
+
     def process(self, game: RefChess, effect: str, args):
         if effect == "set_piece":
             tile_i, piece_id = args[0], args[1]
@@ -13,6 +16,9 @@ class SetPieceRuleL(Rule):
 
 
 class NextTurnRuleL(Rule):
+    consumes = ["moved"]
+    emits = ["turn_changed"]
+
     def process(self, game: RefChess, effect: str, args):
         if effect == "moved":
             game.chess = NextTurnA(game.chess)
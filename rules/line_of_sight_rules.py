@@ -2,6 +2,7 @@ from structures.chess_structures import *
 from rules.rules import *
 from structures.structures import *
 from structures.colours import *
+from rules.drawing_rules import *
 
 
 class LineOfSightRule(Rule):
@@ -80,28 +81,22 @@ class TouchCensorRule(Rule):
 
 
 class ServerLoSRule(Rule):
-    def __init__(self, subruleset: Ruleset, move0):
-        Rule.__init__(self, watch=["init", "board_change", "connect"])
+    def __init__(self, validator, table):
+        Rule.__init__(self, watch=["init", "board_change"])
 
-        self.subruleset = subruleset
-        self.move0 = move0
+        self.validator = validator  # shared between rooms, see server.move_validation
+        self.table = table  # as in DrawReplaceRule, views are sent as finished messages
 
-        self.success_indicator = IndicatorRule(["move_success"])
-        self.subruleset.add_rule(self.success_indicator)
+    def snapshot(self, game: Chess, player, snap):
+        view = game.get_board().get_views().get(player, None)
+        if view is None:  # spectators are never sent a view, they see the board as it is
+            return
 
-    def process(self, game: Chess, effect: str, args):
-        if effect == "connect":
-            view = game.get_board().get_views().get(args, None)
-
-            if view:
-                res = [("set_filter", args)]
-                for tile in view["visible"]:
-                    res += [("draw_piece", tile)]
-                for tile in view["invisible"]:
-                    res += [("overlay", (tile, "#", HEXCOL["fog"])), ("draw_piece_at2", (tile, "", HEXCOL[args]))]
-                res += [("set_filter", "all")]
-                return res
+        for tile in view["invisible"]:
+            snap["pieces"][tile] = ("", HEXCOL.get(player, ""))
+            snap["overlays"] += [(tile, "#", HEXCOL["fog"])]
 
+    def process(self, game: Chess, effect: str, args):
         if effect in ["init", "board_change"]:
             board = game.board
             views = board.get_views()
@@ -117,43 +112,39 @@ class ServerLoSRule(Rule):
                     pieces.setdefault(player, []).append((tile, piece))
                     visible.setdefault(player, set()).add(tile)
 
+            position = self.validator.position_key(game)
+            for player in pieces:
+                for start, piece in pieces[player]:
+                    visible[player].update(self.validator.valid_targets(game, start, position))
+
             for tile in tiles:
                 for player in pieces:
-                    if tile in visible.get(player, ()) or tile in invisible.get(player, ()):
-                        continue
-
-                    can_see = False
-                    for start, piece in pieces[player]:
-                        can_see = is_valid(self.success_indicator, self.move0, self.subruleset, start, tile)
-                        if can_see:
-                            visible.setdefault(player, set()).add(tile)
-                            break
-
-                    if not can_see:
+                    if tile not in visible[player]:
                         invisible.setdefault(player, set()).add(tile)
 
             elist = []
             for player in visible:
-                visible_p, invisible_p = visible[player], invisible[player]
+                visible_p, invisible_p = visible[player], invisible.get(player, set())
 
-                elist += [("set_filter", player)]
+                messages = []
                 for tile in visible_p:
-                    elist += [("draw_piece", tile)]
+                    messages += [("draw_piece", (tile, *piece_look(board.get_piece(tile), self.table)))]
                 for tile in invisible_p:
-                    elist += [("draw_piece_at2", (tile, "", HEXCOL[player]))]
+                    messages += [("draw_piece", (tile, "", HEXCOL[player]))]
 
                 view = views.setdefault(player, {"visible": set(), "invisible": set()})
                 became_visible = view["invisible"].intersection(visible_p)
                 became_invisible = view["visible"].intersection(invisible_p)
 
                 for tile in became_visible:
-                    elist += [("overlay", (tile, "", HEXCOL["fog"]))]
+                    messages += [("overlay", (tile, "", HEXCOL["fog"]))]
                 for tile in became_invisible:
-                    elist += [("overlay", (tile, "#", HEXCOL["fog"]))]
+                    messages += [("overlay", (tile, "#", HEXCOL["fog"]))]
 
                 view["visible"] = visible_p
                 view["invisible"] = invisible_p
-            elist += [("set_filter", "all")]
+
+                elist += [("send_to", ([player], msg)) for msg in messages]
 
             return elist
 
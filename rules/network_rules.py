@@ -14,6 +14,9 @@ class ColourRollRule(Rule):
         self.cause = cause
         self.consequence = consequence
 
+        self.consumes = [cause]
+        self.emits = ["set_player", consequence, "exit"]
+
     def process(self, game: Chess, effect: str, args):
         if effect == self.cause:
             roll1 = random.getrandbits(64)
@@ -36,6 +39,9 @@ class ReceiveRule(Rule):
     def __init__(self, network0):
         self.network0 = network0
 
+        self.consumes = ["init"]
+        self.emits = []
+
     def run(self, game: Chess):
         try:
             game.receiving = True
@@ -67,6 +73,9 @@ class SendRule(Rule):
     def __init__(self, whitelist: List[Rule]):
         self.whitelist = whitelist
 
+        self.consumes = list(whitelist)
+        self.emits = []
+
     def process(self, game: Chess, effect: str, args):
         if not game.receiving:
             if effect in self.whitelist:
@@ -74,6 +83,9 @@ class SendRule(Rule):
 
 
 class CloseSocket(Rule):
+    consumes = ["exit"]
+    emits = []
+
     def process(self, game: Chess, effect: str, args):
         if effect == "exit":
             game.tkchess.after(1000, lambda: self.close(game))
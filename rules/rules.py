@@ -1,9 +1,16 @@
-from typing import List
+from typing import List, Optional
 
 from structures.structures import *
 
 
 class Rule:
+    watch: List[str] = ["all"]
+
+    consumes: Optional[List[str]] = None  # optional declarations, used by utility.effect_flow to narrow "all"
+    emits: Optional[List[str]] = None
+
+    state_attrs: List[str] = []  # attributes that make up the rule's part of a game in progress, see server.room_state
+
     def __init__(self, watch: List[str] = None):
         self.watch = ["all"] if watch is None else watch
 
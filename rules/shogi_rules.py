@@ -230,12 +230,18 @@ class ShogiPromoteStartRule(Rule):
 
 
 class ShogiPromoteReadRule(Rule):
+    state_attrs = ["promoting"]
+
     def __init__(self):
         Rule.__init__(self, watch=["promote", "promoting", "readstring"])
 
         self.promotion = {"R": "D", "B": "H", "S": "+S", "N": "+N", "L": "+L", "P": "+P"}
         self.promoting = None
 
+    def snapshot(self, game: Chess, player, snap):
+        if self.promoting and self.promoting[1] == player:
+            snap["prompt"] = "Promote [Y/N]?"
+
     def process(self, game: Chess, effect: str, args):
         if effect == "promoting":
             self.promoting = args
@@ -320,11 +326,18 @@ class ShogiTouchRule(Rule):
 
 
 class DropRule(Rule):
+    state_attrs = ["dropping"]
+
     def __init__(self):
         Rule.__init__(self, watch=["drop", "readstring"])
 
         self.dropping = False
 
+    def snapshot(self, game: Chess, player, snap):
+        if self.dropping and self.dropping[1] == player:
+            unique = list(set(game.get_board().get_hand(player)))
+            snap["prompt"] = "Drop? (one of:) " + ", ".join(unique)
+
     def process(self, game: Chess, effect: str, args):
         if effect == "drop":
             tile, player = args
@@ -1 +1 @@
-screen -mdS chess_server python3 serverloop.py
+screen -mdS chess_server python3 serverloop.py --takeover  # a running server hands its rooms over, then exits
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import threading
+import uuid
+
+from collections import deque
+
+import websockets
+
+from structures.chess_structures import *
+from structures.structures import *
+from rules.rules import *
+from server.wire import *
+from server.workers import *
+
+
+class Connection:
+    max_queue = 64  # frames
+    max_overflows = 3  # snapshots in a row without the client reading anything
+    send_timeout = 30
+
+    def __init__(self, game: Chess, player: str, ws: websockets.WebSocketServerProtocol, codec=None, user=None,
+                 worker: RoomWorker = None):
+        self.game = game
+        self.ws = ws
+        self.player = player
+        self.user = user
+        self.codec = JsonCodec() if codec is None else codec
+        self.worker = RoomWorker() if worker is None else worker  # everything touching the game goes through here
+
+        self.loop = asyncio.get_event_loop()
+        self.audience = None
+        self.queue = deque()  # (frame, messages), drained by the writer task
+        self.lock = threading.Lock()  # frames are pushed from wherever the room is processed
+        self.ready = asyncio.Event()
+        self.writer = None
+        self.overflows = 0
+        self.dropped = 0
+        self.flooded = False  # more clicks than the room could queue, see run
+
+    def push(self, frame, messages):
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                self.overflow(messages)
+            else:
+                self.queue.append((frame, messages))
+
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    def overflow(self, messages):
+        # replace everything pending by one frame: the full board as the audience has it, plus whatever was not a draw
+        pending = [msg for _, msgs in self.queue for msg in msgs] + list(messages)
+        kept = [msg for msg in pending if msg[0] not in ["draw_piece", "board_version"]]
+
+        board = self.audience.board
+        snapshot = [("draw_piece", (pos, shape, col)) for pos, (shape, col) in board.items()]
+        snapshot += kept + [("board_version", self.audience.version)]
+
+        self.dropped += len(self.queue)
+        self.queue.clear()
+        self.queue.append((self.codec.encode(snapshot), snapshot))
+
+        self.overflows += 1
+        if self.overflows > self.max_overflows:
+            self.close(1008, "not reading")
+
+    def close(self, code=1000, reason=""):
+        asyncio.run_coroutine_threadsafe(self.ws.close(code, reason), self.loop)
+
+    async def write(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+
+                with self.lock:
+                    frame, _ = self.queue.popleft()
+                await asyncio.wait_for(self.ws.send(frame), self.send_timeout)
+                self.overflows = 0
+        except asyncio.TimeoutError:
+            self.close(1008, "not reading")
+        except websockets.ConnectionClosed:
+            ...
+
+    def depth(self):
+        return len(self.queue)
+
+    async def run(self, channel: "RoomChannel", since=None, epoch=None):
+        handshake = self.codec.handshake()
+        if handshake is not None:
+            await self.ws.send(handshake)
+
+        self.writer = asyncio.ensure_future(self.write())
+
+        self.worker.submit(self.start, channel, since, epoch)
+        try:
+            async for msg in self.ws:
+                if self.flooded:  # read off whatever is left until the close goes through
+                    continue
+
+                data = json.loads(msg)
+
+                eff, arg = data
+                if eff == "click":
+                    if not self.worker.offer(self.game.process, "touch", (arg, self.player)):
+                        # a lost click would leave half a move selected, the client comes back and catches up instead
+                        self.flooded = True
+                        self.close(1008, "too much input")
+                elif eff == "write":  # answers to prompts the room waits on, never dropped
+                    self.worker.submit(self.game.process, "readstring", (arg, self.player))
+                elif eff == "resync":  # the client missed a board version, send everything again
+                    self.worker.submit(channel.resync, self)
+        finally:
+            self.writer.cancel()
+            self.worker.submit(self.stop, channel)
+
+    def start(self, channel: "RoomChannel", since, epoch):
+        if not channel.attach(self, since, epoch):  # nothing to resume from, start over with a snapshot
+            self.game.process("connect", self.player)
+
+    def stop(self, channel: "RoomChannel"):
+        if channel.detach(self):  # not if a newer socket of the same user replaced this one
+            self.game.process("disconnect", self.player)
+
+
+class Audience:  # all connections that see the same messages, i.e. that play the same colour
+    log_size = 256  # frames kept for reconnecting clients
+
+    def __init__(self):
+        self.connections = {}  # user -> Connection
+        self.buffer = []  # messages of the current top-level process, sent as one frame
+
+        self.log = deque(maxlen=self.log_size)  # (seq, messages) of the latest frames
+        self.horizon = 0  # the newest seq that fell out of the log
+
+        self.board = {}  # tile -> (shape, colour) as last sent to this audience
+        self.version = 0
+
+    def delta(self, messages):
+        out = []
+        changed = False
+
+        for msg in messages:
+            effect, args = msg
+
+            if effect == "draw_piece":
+                pos, shape, col = args
+                pos = tuple(pos)
+
+                if self.board.get(pos) == (shape, col):
+                    continue
+
+                self.board[pos] = (shape, col)
+                changed = True
+            elif effect == "snapshot":  # replaces the whole board
+                self.board = {tuple(pos): (shape, col) for pos, shape, col in args["pieces"]}
+                changed = True
+
+            out.append(msg)
+
+        if changed:
+            self.version += 1
+            out.append(("board_version", self.version))
+
+        return out
+
+    def since(self, seq):  # everything after seq, or None if part of it is no longer in the log
+        if seq < self.horizon:
+            return None
+
+        return [msg for s, messages in self.log if s > seq for msg in messages]
+
+    def flush(self, seq):
+        messages, self.buffer = self.buffer, []
+
+        messages = self.delta(messages)  # also while nobody is connected, a reconnecting client resumes from the log
+        if not messages:
+            return False
+
+        messages.append(("seq", seq))
+
+        if len(self.log) == self.log.maxlen:
+            self.horizon = self.log[0][0]
+        self.log.append((seq, messages))
+
+        frames = {}  # serialized once per codec, shared by every socket in the audience
+        for conn in self.connections.values():
+            name = conn.codec.name
+
+            if name not in frames:
+                frames[name] = conn.codec.encode(messages)
+
+            conn.push(frames[name], messages)
+
+        return True
+
+
+class RoomChannel(Rule):
+    def __init__(self, game: Chess):
+        Rule.__init__(self, ["send_raw", "send_filter", "send_to"])
+
+        self.audiences = {}
+        self.connections = {}  # user -> Connection, at most one live socket per user
+        self.seq = 0  # of the last frame sent to any audience
+        self.epoch = uuid.uuid4().hex  # seq counts within this instance of the room, a rebuilt one starts over
+        game.ruleset.add_flush_hook(self.flush)
+
+    def attach(self, conn: Connection, since=None, epoch=None):  # True if conn picks up after frame `since`
+        old = self.connections.get(conn.user)
+        if old is not None:  # the same user in a new tab, or back before the old socket timed out
+            self.detach(old)
+            old.close(1000, "replaced")
+
+        audience = self.audiences.setdefault(conn.player, Audience())
+        audience.connections[conn.user] = conn
+        conn.audience = audience
+        self.connections[conn.user] = conn
+
+        hello = [("epoch", self.epoch)]  # before any seq, so the client knows which room its seqs count in
+        conn.push(conn.codec.encode(hello), hello)
+
+        missed = None
+        if since is not None and epoch == self.epoch and since <= self.seq:
+            missed = audience.since(since)
+
+        if missed is None:
+            audience.board = {}  # the newcomer has seen nothing, the connect snapshot goes to the whole audience
+            return False
+
+        if missed:
+            conn.push(conn.codec.encode(missed), missed)
+
+        return True
+
+    def detach(self, conn: Connection):  # True if conn was still attached
+        if self.connections.get(conn.user) is not conn:
+            return False
+
+        del self.connections[conn.user]
+        del self.audiences[conn.player].connections[conn.user]
+        return True
+
+    def resync(self, conn: Connection):
+        self.audiences[conn.player].board = {}
+        conn.game.process("resync", conn.player)
+
+    def process(self, game: Game, effect: str, args):
+        if effect == "send_raw":
+            for audience in self.audiences.values():
+                audience.buffer.append(args)
+        elif effect == "send_filter":
+            for player, audience in self.audiences.items():
+                if player in args[1]:
+                    audience.buffer.append(args[0])
+        elif effect == "send_to":  # (players, message), straight to those audiences
+            players, msg = args
+            for player in players:
+                if player in self.audiences:
+                    self.audiences[player].buffer.append(msg)
+
+    def flush(self):
+        for audience in self.audiences.values():
+            if audience.flush(self.seq + 1):
+                self.seq += 1
+
+    def metrics(self):
+        return {player: [{"queue": conn.depth(), "dropped": conn.dropped, "overflows": conn.overflows}
+                         for conn in audience.connections.values()]
+                for player, audience in self.audiences.items()}
+
+
+__all__ = ["Connection", "Audience", "RoomChannel"]
@@ -2,16 +2,26 @@ import asyncio
 import json
 import logging
 import os
+import pickle
 import sys
 import threading
 import time
 import traceback
+import zlib
 
 import websockets
 
 from functools import partial
+from urllib.parse import quote
 
 from server.server_rules import *
+from server.move_validation import *
+from server.wire import *
+from server.channels import *
+from server.workers import *
+from server.sharding import *
+from server.room_state import *
+from server.persistence import *
 from rules.chess_rules import *
 from rules.normal_chess_rules import *
 from rules.fairy_rules import *
@@ -20,45 +30,64 @@ from structures.shogi_structures import *
 from structures.chess_structures import *
 from rules.drawing_rules import *
 from structures.structures import *
+from structures.compiled_ruleset import *
 from rules.rules import *
 from rules.line_of_sight_rules import *
 
 
 logging.basicConfig(filename="gameserver.log", level=logging.WARNING)
+METRICS = logging.getLogger("metrics")  # to the same log, see GameServer.report_metrics
+METRICS.setLevel(logging.INFO)
 
 
 def min_server_actions():
+    # "all" includes the spectators ("none"), so they are sent the moves as well and not only their connect snapshot
     return [TakeRule(), MoveTakeRule(), SetPieceRule(), SetPlayerRule(),
-            WebTranslateRule(), StatusRule(), LockRule(), SendFilterRule(["b", "w"]), TouchStartsTurnRule("touch")]
+            WebTranslateRule(), StatusRule(), LockRule(), SendFilterRule(["b", "w", "none"]), TouchStartsTurnRule("touch")]
 
 
 def server_actions():
-    return min_server_actions() + [ConnectRedrawRule()]
+    return min_server_actions()
 
 
-def make_pure_moves(game, piece_move):
-    pure_types = [[IdMoveRule], [FriendlyFireRule]] + piece_move  # pure moves (i.e. no side effects)
-    pure0, pure, pure1 = chain_rules(pure_types, "move")
+CHESS_MOVES = [[PawnSingleRule, PawnDoubleRule, PawnTakeRule, PawnEnPassantRule, KnightRule,
+                BishopRule, RookRule, QueenRule, KingRule, CastleRule]]
+FAIRY_MOVES = [[FerzRule, JumperRule, KirinRule, ShooterRule, WheelRule, KingRule]]
+SHOGI_MOVES = [[KingRule, SRookRule, DragonRule, SBishopRule, HorseRule, GoldRule,
+                SilverRule, PromotedSilverRule, CassiaRule, PromotedCassiaRule, Lance,
+                PromotedLanceRule, SoldierRule, PromotedSoldierRule]]
 
-    subruleset = Ruleset(game)  # create new logic system
-    subruleset.debug = False  # beware, setting to True will often generate an unreadable amount of output
+VARIANT_MOVES = {"chess": CHESS_MOVES, "fairy": FAIRY_MOVES, "shogi": SHOGI_MOVES}
+MODE_VARIANTS = {"normal": "chess", "line": "chess", "fairy": "fairy", "shogi": "shogi"}
 
-    subruleset.add_all(pure)
-    subruleset.add_rule(SuccesfulMoveRule(pure1))
+ROOM_TIMEOUT = 10 * 60  # seconds without input before a room is stopped, or without players once it is hibernated
 
-    return subruleset
+DRAW_TABLES = {"chess": {"K": "king.svg", "D": "queen.svg", "T": "rook.svg", "L": "bishop.svg", "P": "knight.svg",
+                         "p": "pawn.svg"},
+               "fairy": {"K": "king.svg", "F": "ferz.svg", "S": "shooter.svg", "J": "jumper.svg", "C": "kirin.svg",
+                         "W": "wheel.svg"},
+               "shogi": {"K": "king.svg", "L": "lance.svg", "N": "knight.svg", "S": "silver.svg", "G": "gold.svg",
+                         "B": "bishop.svg", "R": "rook.svg", "P": "pawn.svg", "D": "dragon.svg", "H": "horse.svg",
+                         "+P": "pawnplus.svg", "+S": "silverplus.svg", "+N": "knightplus.svg",
+                         "+L": "lanceplus.svg"}}
 
 
-def make_markvalid(game, piece_move, move_start):
-    subruleset = make_pure_moves(game, piece_move)
-    return MarkValidRule2(subruleset, move_start)
+def make_validators():
+    return {variant: MoveValidator(piece_move, variant) for variant, piece_move in VARIANT_MOVES.items()}
 
 
-def setup_chess(mode):
+def setup_chess(mode, validators=None, worker: RoomWorker = None, recorder: GameRecorder = None):
+    if mode not in MODE_VARIANTS:
+        return
+
+    if validators is None:
+        validators = make_validators()
+    validator = validators[MODE_VARIANTS[mode]]
+
     game = Chess()
 
     ruleset = game.ruleset
-    ruleset.add_rule(TimeoutRule(ruleset, 10 * 60, watch=["touch", "readstring"]))
+    ruleset.add_rule(TimeoutRule(ruleset, ROOM_TIMEOUT, watch=["touch", "readstring"]))
     ruleset.add_rule(WinStopRule(), -1)
 
     base_move = [[IdMoveRule], [MoveTurnRule], [MovePlayerRule], [FriendlyFireRule]]
@@ -73,8 +102,7 @@ def setup_chess(mode):
 
         special = [CreatePieceRule({"K": MovedPiece, "p": Pawn, "T": MovedPiece})]
 
-        piece_move = [[PawnSingleRule, PawnDoubleRule, PawnTakeRule, PawnEnPassantRule, KnightRule,
-                      BishopRule, RookRule, QueenRule, KingRule, CastleRule]]
+        piece_move = CHESS_MOVES
 
         move_start, moves, move_end = chain_rules(base_move + piece_move, "move")
         moves.append(SuccesfulMoveRule(move_end))
@@ -85,15 +113,12 @@ def setup_chess(mode):
         actions = server_actions()
         actions.append(TouchMoveRule(move_start))
 
-        ruleset.add_rule(ConnectSetupRule({"board_size": (8, 8)}), 0)
-
-        draw_table = {"K": "king.svg", "D": "queen.svg", "T": "rook.svg", "L": "bishop.svg", "P": "knight.svg",
-                      "p": "pawn.svg"}
+        cfg = {"board_size": (8, 8)}
 
         start = "wa8Th8Tb8Pg8Pc8Lf8Ld8De8Ka7pb7pc7pd7pe7pf7pg7ph7p;" \
                 "ba1Th1Tb1Pg1Pc1Lf1Ld1De1Ka2pb2pc2pd2pe2pf2pg2ph2p"
         drawing = normal_drawing
-        drawing.append(make_markvalid(game, piece_move, move_start))
+        drawing.append(MarkValidRule2(validator))
         # can't have this in LoS because then 2nd order moves tell positions of unseen :p
     elif mode == "fairy":
         board = Board(game)
@@ -102,7 +127,7 @@ def setup_chess(mode):
 
         special = [CreatePieceRule({})]
 
-        piece_move = [[FerzRule, JumperRule, KirinRule, ShooterRule, WheelRule, KingRule]]
+        piece_move = FAIRY_MOVES
 
         move_start, moves, move_end = chain_rules(base_move + piece_move, "move")
         moves.append(SuccesfulMoveRule(move_end))
@@ -113,15 +138,12 @@ def setup_chess(mode):
         actions = server_actions()
         actions.append(TouchMoveRule(move_start))
 
-        ruleset.add_rule(ConnectSetupRule({"board_size": (8, 8)}), 0)
-
-        draw_table = {"K": "king.svg", "F": "ferz.svg", "S": "shooter.svg", "J": "jumper.svg", "C": "kirin.svg",
-                      "W": "wheel.svg"}
+        cfg = {"board_size": (8, 8)}
 
         start = "wa8Sh8Sb8Jg8Jc8Cf8Cd8We8Ka7Fb7Fc7Fd7Fe7Ff7Fg7Fh7F;" \
                 "ba1Sh1Sb1Jg1Jc1Cf1Cd1We1Ka2Fb2Fc2Fd2Fe2Ff2Fg2Fh2F"
         drawing = normal_drawing
-        drawing.append(make_markvalid(game, piece_move, move_start))
+        drawing.append(MarkValidRule2(validator))
     elif mode == "shogi":
         board = ShogiBoard(game)
         board.make_tiles(NormalTile)
@@ -129,9 +151,7 @@ def setup_chess(mode):
 
         special = [CreatePieceRule({}), DropRule()]
 
-        piece_move = [[KingRule, SRookRule, DragonRule, SBishopRule, HorseRule, GoldRule,
-                       SilverRule, PromotedSilverRule, CassiaRule, PromotedCassiaRule, Lance,
-                       PromotedLanceRule, SoldierRule, PromotedSoldierRule]]
+        piece_move = SHOGI_MOVES
 
         post_move = [ShogiPromoteStartRule(), ShogiPromoteReadRule(), ShogiTakeRule(),
                      CaptureRule(), WinRule()]
@@ -142,16 +162,12 @@ def setup_chess(mode):
         actions = server_actions()
         actions.append(ShogiTouchRule(move_start))
 
-        ruleset.add_rule(ConnectSetupRule({"board_size": (9, 9)}), 0)
-
-        draw_table = {"K": "king.svg", "L": "lance.svg", "N": "knight.svg", "S": "silver.svg", "G": "gold.svg",
-                      "B": "bishop.svg", "R": "rook.svg", "P": "pawn.svg", "D": "dragon.svg", "H": "horse.svg",
-                      "+P": "pawnplus.svg", "+S": "silverplus.svg", "+N": "knightplus.svg", "+L": "lanceplus.svg"}
+        cfg = {"board_size": (9, 9)}
 
         start = "wa9Lb9Nc9Sd9Ge9Kf9Gg9Sh9Ni9L" + "b8Bh8R" + "a7Pb7Pc7Pd7Pe7Pf7Pg7Ph7Pi7P;" \
                 "ba1Lb1Nc1Sd1Ge1Kf1Gg1Sh1Ni1L" + "b2Rh2B" + "a3Pb3Pc3Pd3Pe3Pf3Pg3Ph3Pi3P"
         drawing = normal_drawing
-        drawing.append(make_markvalid(game, piece_move, move_start))
+        drawing.append(MarkValidRule2(validator, strict=False))  # empty tiles start drops
     elif mode == "line":
         board = Board(game)
         board.make_tiles(NormalTile)
@@ -159,8 +175,7 @@ def setup_chess(mode):
 
         special = [CreatePieceRule({"K": MovedPiece, "p": Pawn, "T": MovedPiece})]
 
-        piece_move = [[PawnSingleRule, PawnDoubleRule, PawnTakeRule, PawnEnPassantRule, KnightRule,
-                      BishopRule, RookRule, QueenRule, KingRule, CastleRule]]
+        piece_move = CHESS_MOVES
 
         move_start, moves, move_end = chain_rules(base_move + piece_move, "move")
         moves.append(SuccesfulMoveRule(move_end))
@@ -172,51 +187,351 @@ def setup_chess(mode):
         actions.append(TouchCensorRule("touch2"))
         actions.append(TouchMoveRule(move_start, cause="touch2"))
 
-        ruleset.add_rule(ConnectSetupRule({"board_size": (8, 8)}), 0)
-
-        draw_table = {"K": "king.svg", "D": "queen.svg", "T": "rook.svg", "L": "bishop.svg", "P": "knight.svg",
-                      "p": "pawn.svg"}
+        cfg = {"board_size": (8, 8)}
 
         start = "wa8Th8Tb8Pg8Pc8Lf8Ld8De8Ka7pb7pc7pd7pe7pf7pg7ph7p;" \
                 "ba1Th1Tb1Pg1Pc1Lf1Ld1De1Ka2pb2pc2pd2pe2pf2pg2ph2p"
         drawing = lazy_drawing + [TurnFilterRule({"select": "select2"}), SelectRule("select2")]
-        drawing.append(ServerLoSRule(make_pure_moves(game, piece_move), move_start))
+        drawing.append(ServerLoSRule(validator, DRAW_TABLES[MODE_VARIANTS[mode]]))
     else:
         return
 
-    drawing.append(DrawReplaceRule(draw_table))
+    drawing.append(DrawReplaceRule(DRAW_TABLES[MODE_VARIANTS[mode]]))
+    drawing.append(SnapshotRule(cfg, DRAW_TABLES[MODE_VARIANTS[mode]]))
 
     ruleset.add_all(special + moves + post_move + actions + drawing)
     ruleset.add_all(late, prio=-2)
 
+    ruleset.coalesce(["board_change"])  # castling and promotions would otherwise recompute line of sight 2-3 times
+
+    compile_ruleset(ruleset, mode)  # the layout is fixed per mode, so the generated dispatch is shared between rooms
+    if worker is not None:
+        ruleset.defer, ruleset.spawn = worker.defer, worker.spawn
+
     game.load_board_str(start)
+
+    if recorder is not None:  # only what happens after the start position
+        recorder.begin(mode, start)
+        ruleset.add_rule(recorder)
+
     ruleset.process("init", ())
 
     return game
 
 
 class GameServer:
-    def __init__(self, port):
+    sync_interval = 1  # seconds between the fsyncs of every journal, the most input a crash can lose
+    snapshot_every = 64  # journal entries, after which the room is saved whole and its journal starts over
+    metrics_interval = 60  # seconds between the metrics written to the log
+
+    def __init__(self, port, workers=0, placement=None, handoff=None, store=None, records=None, hibernate_after=None):
         self.port = port
         self.games = {}
 
-    def run(self):
-        start_server = websockets.serve(self.accept, "", self.port)
+        self.placement = placement  # a ShardMap or NodePlacement, None if this process owns every room
+
+        self.handoff = handoff  # path of a unix socket through which a newer process takes over the rooms
+        self.servers = []
+        self.ready = asyncio.Event()  # cleared while rooms handed over from an older process are being put in place
+        self.ready.set()
+        self.handed_off = False
+
+        self.store = store  # a RoomStore to survive crashes, None to keep the rooms in memory only
+        self.records = records  # directory to record every game in, see GameRecorder
+        if records is not None:
+            os.makedirs(records, exist_ok=True)
+
+        self.hibernate_after = hibernate_after  # seconds without sockets before a room is put away, None to never
+        self.hibernated = {}  # room id -> (CloseRoomRule of the room as it was, compressed room state, time last left)
+
+        self.validators = make_validators()
+
+        # rooms take turns on worker threads (or on the event loop without any), each room on one thread at a time
+        self.scheduler = RoomScheduler(asyncio.get_event_loop(), workers)
+
+    def listen(self):
+        listen = [(self.port, False)] if self.placement is None else self.placement.listen(self.port)
+
+        # with a handoff, the next process binds the same ports before this one lets go of them
+        return [(port, reuse_port or self.handoff is not None) for port, reuse_port in listen]
+
+    def run(self, takeover=False):
+        loop = asyncio.get_event_loop()
+
+        for port, reuse_port in self.listen():
+            server = loop.run_until_complete(websockets.serve(self.accept, "", port, reuse_port=reuse_port))
+            self.servers.append(server)
+
+        if self.placement is not None:
+            loop.create_task(self.placement.maintain())
+
+        if self.handoff is not None:
+            if takeover:
+                self.ready.clear()  # clients arriving meanwhile wait for the rooms
+                loop.run_until_complete(self.take_over())
+                self.ready.set()
+
+            loop.run_until_complete(asyncio.start_unix_server(self.hand_over, self.handoff))
+            os.chmod(self.handoff, 0o600)
+
+        if self.store is not None:
+            self.ready.clear()
+            self.restore()  # whatever a crash left behind, rooms taken over are already up to date
+            self.ready.set()
+
+            loop.create_task(self.sync())
+
+        if self.hibernate_after is not None:
+            loop.create_task(self.hibernate_idle())
+
+        loop.create_task(self.report_metrics())
+
+        loop.run_forever()
+
+    def make_room(self, mode, room_id, record=None):  # record is (fn, offset) to carry on with an earlier recording
+        recorder = None
+        if record is not None:
+            recorder = GameRecorder(*record)
+        elif self.records is not None:
+            fn = quote(room_id, safe="") + time.strftime("_%Y_%m_%d_%H_%M_%S.chs")
+            recorder = GameRecorder(os.path.join(self.records, fn))
+
+        worker = RoomWorker(self.scheduler)
+        chess = setup_chess(mode, self.validators, worker, recorder)
+        closer = CloseRoomRule(self, room_id)
+        chess.ruleset.add_rule(closer)
+        channel = RoomChannel(chess)
+        chess.ruleset.add_rule(channel)
+
+        self.games[room_id] = {"game": chess, "players": {}, "channel": channel, "worker": worker, "mode": mode,
+                               "recorder": recorder, "closer": closer, "sockets": 0, "idle": time.perf_counter()}
+        if self.placement is not None:
+            self.placement.keep(room_id)
+
+        return self.games[room_id]
+
+    @staticmethod
+    async def on_worker(room_data, fn, *args):  # the result of fn, run by the room's worker after what it has queued
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def call():
+            try:
+                res = fn(*args)
+                loop.call_soon_threadsafe(future.set_result, res)
+            except Exception as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+
+        room_data["worker"].submit(call)
+        return await future
+
+    @staticmethod
+    def room_state(room_data):  # on the room's worker
+        recorder = room_data["recorder"]
+        record = None if recorder is None else (recorder.fn, recorder.position())
+
+        return {"mode": room_data["mode"], "players": dict(room_data["players"]), "game": dump_game(room_data["game"]),
+                "record": record}
+
+    def handoff_state(self, room_data):  # on the room's worker
+        state = self.room_state(room_data)
+        if "journal" in room_data:  # the new process appends to the same journal, its indices carry on
+            state["entries"] = room_data["journal"].count
+
+        return state
+
+    async def dump_room(self, room_data):
+        return await self.on_worker(room_data, self.handoff_state, room_data)
+
+    def load_room(self, room_id, state):
+        room_data = self.make_room(state["mode"], room_id, state.get("record"))
+        room_data["players"].update(state["players"])
+
+        load_game(room_data["game"], state["game"])
+        return room_data
+
+    def keep(self, room_id, room_data, count=0):  # journal the room from here on
+        if self.store is None:
+            return
+
+        journal = self.store.open(room_id, count)
+        room_data["journal"] = journal
+        room_data["game"].ruleset.add_rule(JournalRule(journal))
+
+        room_data["worker"].submit(self.snapshot, room_id, room_data)
+
+    def snapshot(self, room_id, room_data):  # on the room's worker, in between inputs
+        journal = room_data["journal"]
+        state = self.room_state(room_data)
+        state["entries"] = journal.count
+
+        self.store.save(room_id, state)
+        journal.reset()
+        room_data["saving"] = False
+        return state
+
+    def restore(self):
+        for room_id, state, entries in self.store.rooms():
+            if room_id in self.games:
+                continue
+
+            try:
+                room_data = self.load_room(room_id, state)
+                players = room_data["players"]
+
+                for _, effect, args in entries:
+                    if effect == "join":
+                        user_id, colour = args
+                        players[user_id] = colour
+
+                        if room_data["recorder"] is not None:
+                            room_data["recorder"].join(user_id, colour)
+                    else:
+                        room_data["game"].process(effect, tuple(args))
 
-        asyncio.get_event_loop().run_until_complete(start_server)
-        asyncio.get_event_loop().run_forever()
+                count = entries[-1][0] if entries else state["entries"]
+                self.keep(room_id, room_data, count)
+            except Exception:
+                logging.error(f"could not restore room {room_id}", exc_info=sys.exc_info())
+                self.games.pop(room_id, None)
 
-    async def do_room(self, ws, mode, room_id, user_id):
-        if room_id not in self.games:
-            chess = setup_chess(mode)
-            chess.ruleset.add_rule(CloseRoomRule(self, room_id))
-            self.games[room_id] = {"game": chess, "players": {}, "sockets": []}
+    async def sync(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.sync_interval)
+
+            rooms = [(room_id, room_data) for room_id, room_data in list(self.games.items()) if "journal" in room_data]
+            journals = [room_data["journal"] for _, room_data in rooms]
+
+            def sync_all():
+                for journal in journals:
+                    journal.sync()
+
+            try:
+                await loop.run_in_executor(None, sync_all)  # one batch of fsyncs, off the loop and the rooms
+            except OSError:
+                logging.error("could not sync the room journals", exc_info=sys.exc_info())
+
+            for room_id, room_data in rooms:
+                if room_data["journal"].unsaved >= self.snapshot_every and not room_data.get("saving"):
+                    room_data["saving"] = True
+                    room_data["worker"].submit(self.snapshot, room_id, room_data)
+
+    def hibernate_state(self, room_id, room_data):  # on the room's worker, the room takes no input after this
+        if "journal" in room_data:
+            state = self.snapshot(room_id, room_data)
+            room_data["journal"].close()
+        else:
+            state = self.room_state(room_data)
+
+        if room_data["recorder"] is not None:
+            room_data["recorder"].close()
+
+        return state
+
+    async def hibernate(self, room_id):
         room_data = self.games[room_id]
+        done = room_data["hibernating"] = asyncio.get_running_loop().create_future()  # joins wait for this
 
-        chess = room_data["game"]
-        sockets = room_data["sockets"]
+        try:
+            state = await self.on_worker(room_data, self.hibernate_state, room_id, room_data)
+
+            # mode, pieces and their flags, hands, turn and players, none of the rules, tiles or sockets
+            self.hibernated[room_id] = (room_data["closer"], zlib.compress(pickle.dumps(state)), room_data["idle"])
+            del self.games[room_id]
+            room_data["worker"].cancel()
+        except Exception:
+            logging.error(f"could not hibernate room {room_id}", exc_info=sys.exc_info())
+            del room_data["hibernating"]
+        finally:
+            done.set_result(None)
 
-        sockets.append(ws)
+    def wake(self, room_id):
+        _, data, _ = self.hibernated.pop(room_id)
+        state = pickle.loads(zlib.decompress(data))
+
+        room_data = self.load_room(room_id, state)
+        self.keep(room_id, room_data, state.get("entries", 0))
+        return room_data
+
+    async def hibernate_idle(self):
+        while True:
+            await asyncio.sleep(self.hibernate_after / 4)
+
+            now = time.perf_counter()
+            idle = [room_id for room_id, room_data in self.games.items()
+                    if room_data["sockets"] == 0 and now - room_data["idle"] >= self.hibernate_after
+                    and "hibernating" not in room_data]
+
+            await asyncio.gather(*(self.hibernate(room_id) for room_id in idle))  # a slow room holds up no other
+
+            for room_id, (_, _, idle_since) in list(self.hibernated.items()):
+                if now - idle_since >= ROOM_TIMEOUT:  # its TimeoutRule went with the rest of the room
+                    await self.close_room(room_id)
+
+    async def take_over(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.handoff)
+        except OSError:
+            return  # nothing to take over from, a cold start
+
+        writer.write(b"handoff\n")
+        await writer.drain()
+
+        states = pickle.loads(await reader.read())
+        writer.close()
+
+        for room_id, state in states.items():
+            room_data = self.load_room(room_id, state)
+            self.keep(room_id, room_data, state.get("entries", 0))
+
+    async def hand_over(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if (await reader.readline()).strip() != b"handoff":
+            writer.close()
+            return
+
+        for server in self.servers:  # the new process has bound the same ports, it gets every new socket
+            server.close()
+
+        rooms = list(self.games.items())
+        conns = [conn for _, room_data in rooms for conn in list(room_data["channel"].connections.values())]
+        # clients come back on their own, to the new process
+        await asyncio.gather(*(conn.ws.close(1012, "restarting") for conn in conns), return_exceptions=True)
+
+        states = {room_id: pickle.loads(zlib.decompress(data)) for room_id, (_, data, _) in self.hibernated.items()}
+        for room_id, room_data in rooms:
+            try:
+                states[room_id] = await self.dump_room(room_data)
+            except Exception:
+                logging.error(f"could not hand over room {room_id}", exc_info=sys.exc_info())
+
+        writer.write(pickle.dumps(states))
+        await writer.drain()
+        writer.close()
+
+        for _, room_data in rooms:  # the new process carries on with the same files
+            if "journal" in room_data:
+                room_data["journal"].close()
+
+        self.games.clear()
+        self.handed_off = True
+        asyncio.get_running_loop().stop()
+
+    async def do_room(self, ws, mode, room_id, user_id, encoding="json", since=None, epoch=None):
+        room_data = self.games.get(room_id)
+        if room_data is not None and "hibernating" in room_data:
+            await room_data["hibernating"]  # and then wake it up again
+            room_data = self.games.get(room_id)
+
+        if room_data is None:
+            if room_id in self.hibernated:
+                room_data = self.wake(room_id)
+            else:
+                room_data = self.make_room(mode, room_id)
+                self.keep(room_id, room_data)
+
+        chess = room_data["game"]
 
         players = room_data["players"]
         if user_id in players:
@@ -228,22 +543,65 @@ class GameServer:
                 colour = "b"
             else:
                 colour = "none"
-        players[user_id] = colour
 
-        ws_rule = WebSocketRule(chess, colour, ws)
-        chess.ruleset.add_rule(ws_rule)
+            if "journal" in room_data:  # written by the worker, in between its snapshots
+                room_data["worker"].submit(room_data["journal"].record, "join", (user_id, colour))
+            if room_data["recorder"] is not None:
+                room_data["worker"].submit(room_data["recorder"].join, user_id, colour)
+        players[user_id] = colour
 
-        await ws_rule.run()
+        codec = make_codec(encoding, DRAW_TABLES[MODE_VARIANTS[mode]])
+        conn = Connection(chess, colour, ws, codec, user_id, room_data["worker"])
 
-    def close_room(self, room):
+        room_data["sockets"] += 1
         try:
-            room_data = self.games[room]
-
-            for ws in room_data["sockets"]:
-                asyncio.run_coroutine_threadsafe(ws.close(), asyncio.get_event_loop())
+            await conn.run(room_data["channel"], since, epoch)
         finally:
+            room_data["sockets"] -= 1
+            room_data["idle"] = time.perf_counter()
+
+    def metrics(self):
+        rooms = {room_id: {"channel": room_data["channel"].metrics(), "inbound": room_data["worker"].stats()}
+                 for room_id, room_data in self.games.items()}
+
+        return {"scheduler": self.scheduler.stats(), "legal_moves": LEGAL_MOVES.stats(), "rooms": rooms,
+                "hibernated": len(self.hibernated)}
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+
+            METRICS.info(json.dumps(self.metrics()))
+
+    async def close_room(self, room, closer=None):  # closer is the CloseRoomRule of the room that is to be closed
+        room_data = self.games.get(room)
+
+        if room_data is not None and closer in [None, room_data["closer"]]:
             del self.games[room]
 
+            if "journal" in room_data:
+                room_data["journal"].close()
+                self.store.remove(room)  # finished, nothing to restore
+
+            await asyncio.gather(*(conn.ws.close() for conn in list(room_data["channel"].connections.values())))
+            await self.release(room)
+        elif room in self.hibernated and closer in [None, self.hibernated[room][0]]:  # abandoned, see hibernate_idle
+            del self.hibernated[room]
+
+            if self.store is not None:
+                self.store.remove(room)
+
+            await self.release(room)
+
+    async def release(self, room):  # the owner on the ring opens it from now on
+        if self.placement is None:
+            return
+
+        try:
+            await self.placement.release(room)
+        except OSError:  # the next heartbeat leaves it out
+            logging.warning(f"room registry unreachable, could not release room {room}")
+
     async def accept(self, ws: websockets.WebSocketServerProtocol, path):
         print(path)
         if path != "/":
@@ -252,19 +610,39 @@ class GameServer:
 
         try:
             msg = await ws.recv()
+            await self.ready.wait()
 
             data = json.loads(msg)
             mode, room_id, user_id = data["mode"], data["room"], data["user"]
             room_id = room_id + "_" + mode
-
-            await self.do_room(ws, mode, room_id, user_id)
+            encoding = data.get("encoding", "json")  # older clients only speak json
+            since = data.get("seq", None)  # the last frame seen by a reconnecting client
+            epoch = data.get("epoch", None)  # of the room that frame came from
+
+            # rooms that are already here stay here, even if the placement changed since
+            here = room_id in self.games or room_id in self.hibernated
+            if self.placement is not None and not here:
+                try:
+                    elsewhere = await self.placement.claim(room_id)
+                except OSError:  # opening it here could make a second copy
+                    logging.warning(f"room registry unreachable, turning away room {room_id}")
+                    await ws.close(1013, "try again later")
+                    return
+
+                if elsewhere is not None:
+                    await ws.send(json.dumps(("redirect", elsewhere)))
+                    return
+
+            await self.do_room(ws, mode, room_id, user_id, encoding, since, epoch)
         finally:
             await ws.close()
 
 
-def thread_loop(port):
+def thread_loop(port, workers=0, placement=None, handoff=None, takeover=False, store=None, records=None,
+                hibernate_after=None):
     responsive = threading.Event()
     responsive.set()
+    handed_off = threading.Event()
     error_times = []
 
     error_timeout = 10 * 60
@@ -281,7 +659,10 @@ def thread_loop(port):
             logging.log(logging.WARNING, f"encountered {max_errors+1} errors in {error_timeout}s, exiting")
             return
 
-        th = threading.Thread(target=partial(open_server, port=port, responsive=responsive, errors=error_times))
+        th = threading.Thread(target=partial(open_server, port=port, responsive=responsive, errors=error_times,
+                                             workers=workers, placement=placement, handoff=handoff,
+                                             takeover=takeover, handed_off=handed_off, store=store,
+                                             records=records, hibernate_after=hibernate_after))
         th.start()
         while th.is_alive() and responsive.is_set():
             responsive.clear()
@@ -291,10 +672,15 @@ def thread_loop(port):
             logging.log(logging.ERROR, "server thread became unresponsive, crashing")
             os._exit(1)
 
-        time.sleep(restart_timeout)
+        if handed_off.is_set():
+            return  # a newer process runs the rooms now
+
+        takeover = False  # only a fresh deploy takes over, a restart after a crash starts from the store
+        time.sleep(min(restart_timeout, 2 ** len(error_times)))
 
 
-def open_server(port, responsive, errors):
+def open_server(port, responsive, errors, workers=0, placement=None, handoff=None, takeover=False, handed_off=None,
+                store=None, records=None, hibernate_after=None):
     asyncio.set_event_loop(asyncio.new_event_loop())
 
     async def set_responsive_task():
@@ -302,11 +688,19 @@ def open_server(port, responsive, errors):
             responsive.set()
             await asyncio.sleep(5)
 
+    gameserver = None
     try:
         asyncio.run_coroutine_threadsafe(set_responsive_task(), asyncio.get_event_loop())
-        gameserver = GameServer(port=port)
-        gameserver.run()
+        gameserver = GameServer(port=port, workers=workers, placement=placement, handoff=handoff, store=store,
+                                records=records, hibernate_after=hibernate_after)
+        gameserver.run(takeover)
+
+        if gameserver.handed_off and handed_off is not None:
+            handed_off.set()
     except Exception:
         traceback.print_exc()
         logging.error("game server encountered unexpected state", exc_info=sys.exc_info())
         errors.append(time.perf_counter())
+    finally:
+        if gameserver is not None:  # the next restart brings its own
+            gameserver.scheduler.stop()
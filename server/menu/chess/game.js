@@ -2,6 +2,7 @@ const urlParams = new URLSearchParams(window.location.search);
 const room = urlParams.get('room');
 const mode = urlParams.get('mode');
 const user = urlParams.get('user');
+const encoding = urlParams.get('encoding') || "binary";
 
 displayfield = document.querySelector("#playfield");
 overfield = document.querySelector("#overlay");
@@ -13,6 +14,21 @@ let width = 80;
 let height = 80;
 let dr = 80;
 
+let legal = null;  // "x,y" -> valid targets of our pieces, only while it is our turn
+let legalStrict = false;
+let legalMark = ["x", "#0000FF"];
+let selected = null;
+
+let boardVersion = null;  // null while waiting for a full redraw, the first version of an audience may be any
+
+let codes = null;  // string and effect tables of the binary encoding
+
+let lastSeq = null;  // of the last frame received, to resume from after a dropped connection
+let epoch = null;  // of the room lastSeq counts in, a room rebuilt on the server starts counting over
+
+const defaultPort = 19684;
+let redirect = null;  // where the server owning this room listens, if the one we reached does not
+
 
 function toHTML(html) {
   let temp = document.createElement('template');
@@ -73,7 +89,7 @@ function process(effect, args) {
     {
         let [key, value] = args;
 
-        if (key === "board_size") {
+        if (key === "board_size" && playfield.length === 0) {
             let [m, n] = value;
             createBoard(n, m);
         }
@@ -94,17 +110,179 @@ function process(effect, args) {
         let resp = prompt(args);
         socket.send(JSON.stringify(["write", resp]));
     }
+    else if (effect === "snapshot")
+    {
+        for (let key in args["config"])
+            process("config", [key, args["config"][key]]);
+
+        for (let row of overlay)
+            for (let cell of row)
+                cell.innerHTML = "";
+
+        for (let piece of args["pieces"])
+            process("draw_piece", piece);
+        for (let mark of args["overlays"])
+            process("overlay", mark);
+
+        if (args["status"] !== null)
+            statusbox.innerHTML = args["status"];
+        if (args["prompt"] !== null)
+            process("askstring", args["prompt"]);
+    }
+    else if (effect === "board_version")
+    {
+        if (boardVersion !== null && args !== boardVersion + 1) {
+            boardVersion = null;
+            socket.send(JSON.stringify(["resync", null]));
+        }
+        else {
+            boardVersion = args;
+        }
+    }
+    else if (effect === "redirect")
+    {
+        redirect = args;
+    }
+    else if (effect === "seq")
+    {
+        lastSeq = args;
+    }
+    else if (effect === "epoch")
+    {
+        if (args !== epoch)
+            lastSeq = null;
+
+        epoch = args;
+    }
+    else if (effect === "codes")
+    {
+        codes = args;
+        codes.names = {};
+        for (let name in codes.effects)
+            codes.names[codes.effects[name]] = name;
+    }
+    else if (effect === "legal_moves")
+    {
+        legal = {};
+        for (let [tile, targets] of args["moves"])
+            legal[tile.toString()] = targets;
+
+        legalStrict = args["strict"];
+        legalMark = args["mark"];
+        selected = args["selected"] === null ? null : args["selected"].toString();
+    }
+}
+
+
+function markTargets(targets, text) {
+    for (let [j, i] of targets)
+        overlay[i][j].innerHTML = text.fontcolor(legalMark[1]);
+}
+
+
+function click(j, i) {
+    // the server stays authoritative, the table only saves the round trip for highlighting and dead clicks
+    let key = [j, i].toString();
+
+    if (legal !== null) {
+        if (selected === null) {
+            if (key in legal) {
+                selected = key;
+                markTargets(legal[key], legalMark[0]);
+            }
+            else if (legalStrict) {
+                return;
+            }
+        }
+        else {
+            let targets = legal[selected] || [];
+            markTargets(targets, "");
+
+            if (targets.some(([x, y]) => x === j && y === i))
+                legal = null;  // this moves, wait for the next table
+
+            selected = null;
+        }
+    }
+
+    socket.send(JSON.stringify(["click", [j, i]]));
+}
+
+function decodeFrame(buffer) {
+    let view = new DataView(buffer);
+    let strings = codes.strings;
+    let decoder = new TextDecoder();
+    let messages = [];
+
+    let k = 0;
+    while (k < view.byteLength) {
+        let name = codes.names[view.getUint8(k)];
+
+        if (name === "draw_piece" || name === "overlay") {
+            let square = view.getUint8(k + 1);
+            let pos = [square >> 4, square & 15];
+            messages.push([name, [pos, strings[view.getUint8(k + 2)], strings[view.getUint8(k + 3)]]]);
+            k += 4;
+        }
+        else if (name === "board_version" || name === "seq") {
+            messages.push([name, view.getUint32(k + 1)]);
+            k += 5;
+        }
+        else {
+            let n = view.getUint32(k + 1);
+            messages.push(JSON.parse(decoder.decode(new Uint8Array(buffer, k + 5, n))));
+            k += 5 + n;
+        }
+    }
+
+    return messages;
+}
+
+let socket = null;
+
+function connect(port = defaultPort, host = window.location.hostname) {
+    socket = new WebSocket("ws://" + host + ":" + port);
+    socket.binaryType = "arraybuffer";
+    socket.onmessage = function (event) {
+        let msg = event.data;
+
+        if (msg instanceof ArrayBuffer) {
+            for (let [effect, args] of decodeFrame(msg))
+                process(effect, args);
+            return;
+        }
+
+        let data = JSON.parse(msg);
+
+        if (Array.isArray(data[0])) {  // a batch of messages from one server event
+            for (let [effect, args] of data)
+                process(effect, args);
+        }
+        else {
+            process(data[0], data[1]);
+        }
+    };
+    socket.onopen = function (_) {
+        let hello = {"room": room, "mode": mode, "user": user, "encoding": encoding};
+        if (lastSeq !== null) {
+            hello["seq"] = lastSeq;
+            hello["epoch"] = epoch;
+        }
+
+        socket.send(JSON.stringify(hello));
+    };
+    socket.onclose = function (event) {
+        if (redirect !== null) {
+            let {host, port} = redirect;
+            redirect = null;
+            connect(port, host);
+        }
+        else if (event.code !== 1000)  // the room did not close, the connection dropped
+            setTimeout(connect, 1000);
+    };
 }
 
-socket = new WebSocket("ws://" + window.location.hostname + ":19684");
-socket.onmessage = function (event) {
-    let msg = event.data;
-    let data = JSON.parse(msg);
-    process(data[0], data[1]);
-};
-socket.onopen = function (_) {
-    socket.send(JSON.stringify({"room": room, "mode": mode, "user": user}));
-};
+connect();
 
 
 function createBoard(n, m) {
@@ -147,7 +325,7 @@ function createBoard(n, m) {
             cell.innerText = i.toString() + j.toString();
 
             cell.onclick = function (_) {
-                socket.send(JSON.stringify(["click", [j, i]]));
+                click(j, i);
             };
 
             overlay[i].push(ocell);
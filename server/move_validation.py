@@ -0,0 +1,127 @@
+import threading
+
+from collections import OrderedDict
+from typing import List, Type
+
+from rules.rules import *
+from rules.chess_rules import *
+from structures.structures import *
+from structures.chess_structures import *
+from structures.compiled_ruleset import *
+
+
+class LegalMoveCache:  # (variant, position, square) -> valid targets, shared by every room in the process
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+LEGAL_MOVES = LegalMoveCache()
+
+
+def position_key(game: Chess):  # everything the pure move rules read from a position
+    board = game.get_board()
+    turn_num = game.get_turn_num()
+
+    pieces = []
+    for tile_id in board.tile_ids():
+        piece = board.get_piece(tile_id)
+
+        if piece:
+            unmoved = getattr(piece, "moved", 0) == 0
+            passable = piece.double == turn_num - 1
+            pieces.append((tile_id, piece.shape, piece.get_colour(), unmoved, passable))
+
+    return board.shape(), tuple(pieces)
+
+
+class MoveValidator:  # one per variant, shared by every room, the position is passed in on each call
+    def __init__(self, piece_move: List[List[Type[Rule]]], variant: str, cache: LegalMoveCache = LEGAL_MOVES):
+        self.variant = variant
+        self.cache = cache
+
+        pure_types = [[IdMoveRule], [FriendlyFireRule]] + piece_move  # pure moves (i.e. no side effects)
+        self.move0, pure, pure1 = chain_rules(pure_types, "move")
+
+        self.subruleset = Ruleset(None)  # the game is bound per call
+        self.subruleset.debug = False  # beware, setting to True will often generate an unreadable amount of output
+
+        self.subruleset.add_all(pure)
+        self.subruleset.add_rule(SuccesfulMoveRule(pure1))
+
+        self.success_indicator = IndicatorRule(["move_success"])
+        self.subruleset.add_rule(self.success_indicator)
+
+        compile_ruleset(self.subruleset, variant + "_pure")
+
+    def is_valid(self, game: Chess, start, end):
+        with self.subruleset.lock:
+            self.subruleset.game = game
+            try:
+                self.success_indicator.unset()
+                self.subruleset.process(self.move0, (start, end))
+                return bool(self.success_indicator.is_set())
+            finally:
+                self.success_indicator.unset()
+                self.subruleset.game = None
+
+    def search(self, game: Chess, around):
+        with self.subruleset.lock:
+            self.subruleset.game = game
+            try:
+                return list(search_valid(self, game, around))
+            finally:
+                self.subruleset.game = None
+
+    def position_key(self, game: Chess):
+        return position_key(game)
+
+    def valid_targets(self, game: Chess, around, position=None):
+        if position is None:
+            position = position_key(game)
+
+        key = (self.variant, position, tuple(around))
+        valid = self.cache.get(key)
+
+        if valid is None:
+            valid = tuple(self.search(game, around))
+            self.cache.put(key, valid)
+
+        return valid
+
+
+__all__ = ["LegalMoveCache", "LEGAL_MOVES", "position_key", "MoveValidator"]
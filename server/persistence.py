@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import pickle
+import threading
+
+from urllib.parse import quote, unquote
+
+from rules.rules import *
+from structures.structures import *
+
+
+class RoomJournal:  # the inputs of one room, appended as json lines, each with its index
+    def __init__(self, path: str, count=0):
+        self.path = path
+        self.count = count  # index of the last entry written
+        self.unsaved = 0  # entries since the last snapshot
+
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+        self.dirty = False
+
+    def record(self, effect: str, args):  # a buffered write, made durable by the next sync
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.count += 1
+            self.unsaved += 1
+            self.file.write(json.dumps((self.count, effect, args)) + "\n")
+            self.dirty = True
+
+    def sync(self):  # called for every room in turn, off the event loop and the room workers
+        with self.lock:
+            if self.file is None or not self.dirty:
+                return
+
+            self.file.flush()
+            self.dirty = False
+            fd = os.dup(self.file.fileno())  # stays valid should the journal be reset meanwhile
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def reset(self):  # everything so far is in a snapshot
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = open(self.path, "w")
+
+            self.unsaved = 0
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class JournalRule(Rule):  # the client input a room may act on, replayed on top of the last snapshot after a crash
+    def __init__(self, journal: RoomJournal):
+        Rule.__init__(self, watch=["touch", "readstring"])
+
+        self.journal = journal
+
+    def process(self, game: Game, effect: str, args):
+        if effect == "touch" and game.get_turn() not in args[1]:
+            return  # every touch rule ignores the side not to move, and spectators
+
+        self.journal.record(effect, args)
+
+
+class RoomStore:  # one snapshot and one journal per room, in a directory of its own
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, room_id: str, ext: str):
+        return os.path.join(self.directory, quote(room_id, safe="") + ext)
+
+    def open(self, room_id: str, count=0):
+        return RoomJournal(self.path(room_id, ".journal"), count)
+
+    def save(self, room_id: str, state):  # state["entries"] is the last journal entry it includes
+        path = self.path(room_id, ".snap")
+
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(path + ".tmp", path)  # a crash leaves either the old snapshot or the new one
+
+    def remove(self, room_id: str):
+        for ext in [".snap", ".journal"]:
+            try:
+                os.remove(self.path(room_id, ext))
+            except FileNotFoundError:
+                ...
+
+    def entries(self, room_id: str, after: int):
+        try:
+            with open(self.path(room_id, ".journal")) as f:
+                for line in f:
+                    try:
+                        i, effect, args = json.loads(line)
+                    except ValueError:
+                        break  # the tail of a write cut short by the crash
+
+                    if i > after:
+                        yield i, effect, args
+        except FileNotFoundError:
+            ...
+
+    def rooms(self):  # (room_id, snapshot, journal entries after it) of every room left behind
+        for fn in sorted(os.listdir(self.directory)):
+            if not fn.endswith(".snap"):
+                continue
+
+            room_id = unquote(fn[:-len(".snap")])
+            try:
+                with open(os.path.join(self.directory, fn), "rb") as f:
+                    state = pickle.load(f)
+            except Exception:
+                logging.error(f"could not read the snapshot of room {room_id}", exc_info=True)
+                continue
+
+            yield room_id, state, list(self.entries(room_id, state["entries"]))
+
+
+__all__ = ["RoomJournal", "JournalRule", "RoomStore"]
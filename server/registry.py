@@ -0,0 +1,69 @@
+import asyncio
+import json
+import sys
+import time
+
+
+class LocalBroker:  # stand-in for a real service registry, keeps the nodes that sent a heartbeat recently
+    def __init__(self):
+        self.expiry = {}  # node -> time it is dropped
+        self.rooms = {}  # room -> node holding it, void once that node is dropped
+
+    def nodes(self):
+        now = time.time()
+        self.expiry = {node: t for node, t in self.expiry.items() if t > now}
+        return sorted(self.expiry)
+
+    def handle(self, msg):
+        if msg.get("op") == "register":
+            self.expiry[msg["node"]] = time.time() + msg.get("ttl", 15)
+
+            if "rooms" in msg:  # every room the node holds, e.g. claimed again after the broker restarted
+                live = self.nodes()
+                rooms = set(msg["rooms"])
+
+                self.rooms = {room: node for room, node in self.rooms.items() if node != msg["node"] or room in rooms}
+                for room in rooms:
+                    if self.rooms.get(room) not in live:
+                        self.rooms[room] = msg["node"]
+
+            return {"ok": True}
+        elif msg.get("op") == "unregister":
+            self.expiry.pop(msg["node"], None)
+            self.rooms = {room: node for room, node in self.rooms.items() if node != msg["node"]}
+            return {"ok": True}
+        elif msg.get("op") == "nodes":
+            return {"nodes": self.nodes()}
+        elif msg.get("op") == "claim":  # the node holding the room, msg["node"] unless a live node already does
+            holder = self.rooms.get(msg["room"])
+            if holder not in self.nodes():
+                holder = self.rooms[msg["room"]] = msg["node"]
+
+            return {"node": holder}
+        elif msg.get("op") == "release":
+            if self.rooms.get(msg["room"]) == msg["node"]:
+                del self.rooms[msg["room"]]
+
+            return {"ok": True}
+
+        return {"error": "unknown op"}
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            writer.write((json.dumps(self.handle(json.loads(line))) + "\n").encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def run(self, port):
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.start_server(self.serve, "", port))
+        loop.run_forever()
+
+
+__all__ = ["LocalBroker"]
+
+
+if __name__ == "__main__":
+    LocalBroker().run(int(sys.argv[1]) if len(sys.argv) > 1 else 19683)
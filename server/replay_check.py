@@ -0,0 +1,69 @@
+import os
+import sys
+
+from functools import partial
+
+from server.gameserver import setup_chess, MODE_VARIANTS
+from rules.rules import *
+from rules.chess_rules import *
+from structures.compiled_ruleset import *
+
+
+GAME_MODES = {"chess": "normal", "fairy": "fairy"}  # the variants game.py records, as server modes
+
+
+class StartProbe(Rule):  # passed to setup_chess as its recorder, only to learn the start position of a mode
+    def __init__(self):
+        Rule.__init__(self, watch=[])
+
+        self.start = None
+
+    def begin(self, variant: str, start: str, players=None):
+        self.start = start
+
+
+def mode_start(mode: str):
+    probe = StartProbe()
+    setup_chess(mode, recorder=probe)
+    return probe.start
+
+
+def check_records(directory: str):  # (fn, equal, first difference or why it was skipped) of every recording
+    starts = {}
+
+    for fn in sorted(os.listdir(directory)):
+        if not fn.endswith(".chs"):
+            continue
+
+        header, records = read_record(os.path.join(directory, fn))
+        mode = header["variant"]
+        mode = mode if mode in MODE_VARIANTS else GAME_MODES.get(mode)
+
+        if header["start"] is None:  # the old move lists say neither what was played nor from where
+            yield fn, None, "no start position"
+            continue
+        if mode is None:
+            yield fn, None, f"no server mode for {header['variant']}"
+            continue
+
+        if mode not in starts:
+            starts[mode] = mode_start(mode)
+        if header["start"] != starts[mode]:
+            yield fn, None, f"starts elsewhere than {mode}"
+            continue
+
+        equal, difference = replay_equivalence(partial(setup_chess, mode), records)
+        yield fn, equal, difference
+
+
+if __name__ == "__main__":
+    failed = 0
+
+    for fn, equal, difference in check_records(sys.argv[1] if len(sys.argv) > 1 else "records"):
+        if equal is None:
+            print(fn, f"skipped, {difference}", file=sys.stderr)
+        else:
+            print(fn, "ok" if equal else f"differs at {difference}", file=sys.stderr)
+            failed += not equal
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+
+from server.gameserver import GameServer
+from server.persistence import *
+from server.room_state import *
+
+
+ROOM = "check"
+PLAYERS = [("a", "w"), ("b", "b"), ("c", "none")]
+TOUCHES = [("w", (4, 6)), ("w", (4, 4)), ("b", (4, 1)), ("b", (4, 3)),  # e4 e5
+           ("b", (6, 0)), ("none", (3, 6)),  # out of turn, not journaled
+           ("w", (6, 7)), ("w", (5, 5)), ("b", (1, 0)), ("b", (2, 2)),  # Nf3 Nc6
+           ("w", (5, 7))]  # Bf1 left selected
+
+
+async def played_and_restored(mode: str, snapshot_at: int):  # dump_game of a room as played, and as restored
+    directory = tempfile.mkdtemp()
+
+    try:
+        live = GameServer(0, store=RoomStore(directory))
+        room_data = live.make_room(mode, ROOM)
+        live.keep(ROOM, room_data)
+
+        game, worker = room_data["game"], room_data["worker"]
+        for user_id, colour in PLAYERS:  # as do_room journals a join
+            room_data["players"][user_id] = colour
+            worker.submit(room_data["journal"].record, "join", (user_id, colour))
+
+        for player, tile in TOUCHES[:snapshot_at]:
+            worker.submit(game.process, "touch", (list(tile), player))  # as Connection.run, from json
+
+        await live.on_worker(room_data, live.snapshot, ROOM, room_data)
+        for player, tile in TOUCHES[snapshot_at:]:
+            worker.submit(game.process, "touch", (list(tile), player))
+
+        played = await live.on_worker(room_data, dump_game, game)
+        room_data["journal"].sync()
+        room_data["journal"].close()  # the crash
+
+        restored = GameServer(0, store=RoomStore(directory))
+        restored.restore()
+        room_data = restored.games[ROOM]
+
+        return played, await restored.on_worker(room_data, dump_game, room_data["game"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def check_restore(modes=("normal", "line")):  # (what, equal) for snapshots taken before, during and after the touches
+    for mode in modes:
+        for snapshot_at in [0, len(TOUCHES) // 2, len(TOUCHES)]:
+            with contextlib.redirect_stdout(io.StringIO()):  # the rulesets print every effect
+                played, restored = asyncio.run(played_and_restored(mode, snapshot_at))
+            yield f"{mode} snapshot at touch {snapshot_at}", played == restored
+
+
+if __name__ == "__main__":
+    failed = 0
+
+    for what, equal in check_restore():
+        print(what, "ok" if equal else "differs", file=sys.stderr)
+        failed += not equal
+
+    sys.exit(1 if failed else 0)
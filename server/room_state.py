@@ -0,0 +1,66 @@
+from rules.rules import *
+from rules.chess_rules import *
+from structures.chess_structures import *
+from structures.structures import *
+
+
+def ordered_rules(ruleset: Ruleset):
+    found = {i: rule for views in ruleset.watches.values() for _, i, rule in views}
+    return [found[i] for i in sorted(found)]
+
+
+def dump_game(game: Chess):
+    # plain data only (tuples kept), rooms of the same mode are rebuilt by setup_chess and then overwritten with this
+    board = game.get_board()
+
+    pieces = []
+    for tile_id in board.tile_ids():
+        piece = board.get_piece(tile_id)
+
+        if piece:
+            attrs = {k: v for k, v in vars(piece).items() if k not in ["shape", "col"]}
+            pieces.append((tile_id, piece.shape, piece.get_colour(), attrs))
+
+    rules = []
+    for i, rule in enumerate(ordered_rules(game.ruleset)):
+        if rule.state_attrs:
+            rules.append((i, type(rule).__name__, {attr: getattr(rule, attr) for attr in rule.state_attrs}))
+
+    hands = {col: list(hand) for col, hand in getattr(board, "hands", {}).items()}
+
+    return {"turn": game.turn, "turn_num": game.turn_num, "pieces": pieces, "hands": hands, "rules": rules}
+
+
+def load_game(game: Chess, state):
+    board = game.get_board()
+    rules = ordered_rules(game.ruleset)
+
+    constrs = next((rule.constrs for rule in rules if isinstance(rule, CreatePieceRule)), {})
+
+    game.object_map = {0: None}
+    game.obj_count = 1
+
+    for tile_id in board.tile_ids():
+        board.get_tile(tile_id).set_piece(None)
+
+    for tile_id, shape, col, attrs in state["pieces"]:
+        piece = constrs.get(shape, Piece)(shape, col)
+        vars(piece).update(attrs)
+
+        game.add_object(piece)
+        board.get_tile(tile_id).set_piece(piece)
+
+    if hasattr(board, "hands"):
+        board.hands = {col: list(hand) for col, hand in state["hands"].items()}
+
+    for i, name, attrs in state["rules"]:
+        if i < len(rules) and type(rules[i]).__name__ == name:
+            vars(rules[i]).update(attrs)
+
+    game.turn = state["turn"]
+    game.turn_num = state["turn_num"]
+
+    game.process("board_change", ())  # views and move tables follow from the position
+
+
+__all__ = ["dump_game", "load_game"]
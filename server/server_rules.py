@@ -1,5 +1,4 @@
 import asyncio
-import json
 import time
 from collections import deque
 
@@ -7,12 +6,11 @@ import numpy as np
 
 from typing import List
 
-import websockets
-
 from structures.colours import *
 from structures.chess_structures import *
 from structures.structures import *
 from rules.rules import *
+from rules.drawing_rules import *
 
 
 class TurnFilterRule(Rule):
@@ -59,47 +57,116 @@ class MarkRule2(Rule):
 
 
 class MarkValidRule2(Rule):
-    def __init__(self, subruleset: Ruleset, move0):
-        Rule.__init__(self, watch=["selected", "unselected"])
-        self.subruleset = subruleset
-        self.move0 = move0
+    def __init__(self, validator, strict=True):
+        Rule.__init__(self, watch=["selected", "unselected", "init", "board_change", "turn_unlocked", "piece_set",
+                                   "legal_moves", "connect"])
+        self.validator = validator
+        self.strict = strict  # clicks outside the table do nothing, so the client may drop them
 
         self.tags = []
+        self.selected = None
+        self.marker = None  # the side the marks were sent to, they are part of its legal move table
+        self.table = None  # {tile: valid targets} for the side to move, filled in between turns
+
+    def schedule(self, game: Chess):
+        if game.ruleset.defer is None:
+            return  # no server around, selections fall back to searching on demand
+
+        game.ruleset.defer(self.precompute, game)
+
+    def precompute(self, game: Chess):
+        with game.ruleset.lock:
+            if self.table is not None:
+                return
+
+            board = game.get_board()
+            turn = game.get_turn()
+            position = self.validator.position_key(game)
+
+            table = {}
+            for tile_id in board.tile_ids():
+                piece = board.get_piece(tile_id)
+
+                if piece and turn and piece.get_colour() == turn:
+                    table[tile_id] = self.validator.valid_targets(game, tile_id, position)
+
+            self.table = table
 
-        self.success_indicator = IndicatorRule(["move_success"])
-        self.subruleset.add_rule(self.success_indicator)
+            if turn:
+                game.process("legal_moves", turn)
+
+    def send_table(self, player):
+        moves = [(tile, list(targets)) for tile, targets in self.table.items()]
+        table = {"moves": moves, "strict": self.strict, "selected": self.selected, "mark": ("x", HEXCOL["valid"])}
+
+        return [("send_to", ([player], ("legal_moves", table)))]
+
+    def snapshot(self, game: Chess, player, snap):
+        if player == self.marker:
+            snap["overlays"] += [(pos, "x", HEXCOL["valid"]) for pos in self.tags]
 
     def process(self, game: Chess, effect: str, args):
         elist = []
         if effect == "selected":
-            valid = list(search_valid(self, game, around=args))
+            around = tuple(args)
+
+            if self.table is not None and around in self.table:
+                valid = self.table[around]
+            else:
+                valid = self.validator.valid_targets(game, around)
 
+            self.selected = around
+            self.marker = game.get_turn()
+            elist += [("push_filter", self.marker)]
             for pos in valid:
                 self.tags += [pos]
                 elist += [("overlay", (pos, "x", HEXCOL["valid"]))]
+            elist += [("pop_filter", ())]
         elif effect == "unselected":
+            elist += [("push_filter", self.marker)]
             for tag in self.tags:
                 elist += [("overlay", (tag, "", HEXCOL["valid"]))]
+            elist += [("pop_filter", ())]
             self.tags = []
+            self.selected = None
+            self.marker = None
+        elif effect == "legal_moves":
+            if self.table is not None:
+                elist += self.send_table(args)
+        elif effect == "connect":
+            if self.table is not None and args and args == game.get_turn():
+                elist += self.send_table(args)
+        elif effect == "piece_set":
+            self.table = None
+        elif effect in ["init", "board_change", "turn_unlocked"]:
+            self.table = None
+            self.schedule(game)
 
         return elist
 
 
 class StatusRule(Rule):
+    state_attrs = ["won", "status"]
+
     def __init__(self):
-        Rule.__init__(self, watch=["turn_changed", "connect", "wins", "turn_unlocked"])
+        Rule.__init__(self, watch=["turn_changed", "wins", "turn_unlocked"])
 
         self.won = False
+        self.status = None
+
+    def snapshot(self, game: Chess, player, snap):
+        snap["status"] = self.status if self.won else game.get_turn() + " turn"
 
     def process(self, game: Chess, effect: str, args):
         if self.won:
             return
 
-        if effect in ["turn_changed", "connect", "turn_unlocked"]:
+        if effect in ["turn_changed", "turn_unlocked"]:
             return [("status", game.get_turn() + " turn")]
         if effect == "wins":
             self.won = True
-            return [("status", args + " won")]
+            self.status = args + " won"
+            return [("status", self.status)]
 
 
 class PromoteStartRule(Rule):
@@ -130,6 +197,8 @@ class PromoteStartRule(Rule):
 
 
 class LockRule(Rule):
+    state_attrs = ["turn"]
+
     def __init__(self):
         Rule.__init__(self, ["lock_turn", "unlock_turn", "turn_changed"])
 
@@ -160,12 +229,18 @@ class WinStopRule(Rule):
 
 
 class PromoteReadRule(Rule):
+    state_attrs = ["promoting"]
+
     def __init__(self, promotions: List[str]):
         Rule.__init__(self, watch=["promoting", "readstring"])
 
         self.promotions = promotions
         self.promoting = None
 
+    def snapshot(self, game: Chess, player, snap):
+        if self.promoting and self.promoting[1] == player:
+            snap["prompt"] = "Promote to: " + str(self.promotions)
+
     def process(self, game: Chess, effect: str, args):
         if effect == "promoting":
             self.promoting = args
@@ -214,61 +289,33 @@ class SendFilterRule(Rule):
             self.filter = self.stack.pop()
 
 
-class WebSocketRule(Rule):
-    def __init__(self, game: Chess, player: str, ws: websockets.WebSocketServerProtocol):
-        Rule.__init__(self, ["send_raw", "send_filter"])
+class SnapshotRule(Rule):
+    # answers connect and resync with one message holding everything the player should see, built straight from
+    # the game state; any rule with a snapshot(game, player, snap) method adds its part (fog, marks, status, prompts)
+    def __init__(self, cfg, table):
+        Rule.__init__(self, ["connect", "resync"])
 
-        self.game = game
-        self.ws = ws
-        self.player = player
-
-    def process(self, game: Game, effect: str, args):
-        if effect == "send_raw":
-            out = json.dumps(args)
-        elif effect == "send_filter" and self.player in args[1]:
-            out = json.dumps(args[0])
-        else:
-            return
-
-        asyncio.run_coroutine_threadsafe(self.ws.send(out), asyncio.get_event_loop())
-
-    async def run(self):
-        self.game.process("connect", self.player)
-        try:
-            async for msg in self.ws:
-                data = json.loads(msg)
+        self.config = cfg
+        self.table = table  # as in DrawReplaceRule
 
-                eff, arg = data
-                if eff == "click":
-                    self.game.process("touch", (arg, self.player))
-                elif eff == "write":
-                    self.game.process("readstring", (arg, self.player))
-        finally:
-            self.game.ruleset.remove_rule(self)
-            self.game.process("disconnect", self.player)
+    def build(self, game: Chess, player):
+        board = game.get_board()
 
+        snap = {"config": self.config, "pieces": {}, "overlays": [], "status": None, "prompt": None}
+        for tile_id in board.tile_ids():
+            snap["pieces"][tile_id] = piece_look(board.get_piece(tile_id), self.table)
 
-class ConnectSetupRule(Rule):
-    def __init__(self, cfg):
-        Rule.__init__(self, ["connect"])
+        found = {i: rule for views in game.ruleset.watches.values() for _, i, rule in views}
+        for i in sorted(found):
+            if hasattr(found[i], "snapshot"):
+                found[i].snapshot(game, player, snap)
 
-        self.config = cfg
+        snap["pieces"] = [(pos, shape, col) for pos, (shape, col) in snap["pieces"].items()]
+        return snap
 
     def process(self, game: Chess, effect: str, args):
-        if effect == "connect":
-            yield "set_filter", args
-            for key, value in self.config.items():
-                yield "send", ("config", (key, value))
-            yield "set_filter", "all"
-
-
-class ConnectRedrawRule(Rule):
-    def __init__(self):
-        Rule.__init__(self, ["connect"])
-
-    def process(self, game: Game, effect: str, args):
-        if effect == "connect":
-            return [("set_filter", args), ("redraw", ()), ("set_filter", "all")]
+        if effect in ["connect", "resync"]:
+            return [("send_to", ([args], ("snapshot", self.build(game, args))))]
 
 
 class DrawReplaceRule(Rule):
@@ -307,7 +354,7 @@ class WebTranslateRule(Rule):
         elif effect in ["overlay", "status"]:
             return [("send", (effect, args))]
         elif effect == "askstring":
-            return [("send_filter", ((effect, args[0]), args[1]))]
+            return [("send_to", ([args[1]], (effect, args[0])))]
 
 
 class CloseRoomRule(Rule):
@@ -317,8 +364,8 @@ class CloseRoomRule(Rule):
         self.server = server
         self.room = room
 
-    def process(self, game: Chess, effect: str, args):
-        self.server.close_room(self.room)
+    async def process(self, game: Chess, effect: str, args):
+        await self.server.close_room(self.room, self)  # not the room that replaced this one after hibernation
 
 
 class TimeoutRule(Rule):
@@ -328,22 +375,28 @@ class TimeoutRule(Rule):
         self.ruleset = ruleset
         self.timeout = timeout
         self.last_event = time.perf_counter()
+        self.watching = False  # one watcher per room, pushed back by every event instead of a wait per event
 
-    async def poll_timeout(self):
-        while True:
-            if time.perf_counter() - self.last_event > self.timeout:
-                self.ruleset.process("stop", ())
-                return
+    def process(self, game: Chess, effect: str, args):
+        self.last_event = time.perf_counter()
 
-            await asyncio.sleep(self.timeout)
+        if not self.watching and self.ruleset.spawn is not None:
+            self.watching = True
+            self.ruleset.spawn(self.expire())
 
-    def process(self, game: Chess, effect: str, args):
-        if effect == "init":
-            asyncio.run_coroutine_threadsafe(self.poll_timeout(), asyncio.get_event_loop())
+    async def expire(self):
+        remaining = self.timeout
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = self.last_event + self.timeout - time.perf_counter()
 
-        self.timeout = time.perf_counter()
+        self.watching = False
+        if self.ruleset.defer is None:
+            self.ruleset.process("stop", ())
+        else:
+            self.ruleset.defer(self.ruleset.process, "stop", ())
 
 
 __all__ = ["RedrawRule2", "MarkRule2", "MarkValidRule2", "StatusRule", "PromoteReadRule", "LockRule", "WinStopRule",
-           "PromoteStartRule", "WebSocketRule", "ConnectRedrawRule", "WebTranslateRule", "CloseRoomRule", "TimeoutRule",
-           "SendFilterRule", "DrawReplaceRule", "ConnectSetupRule", "TurnFilterRule"]
+           "PromoteStartRule", "WebTranslateRule", "CloseRoomRule", "TimeoutRule",
+           "SendFilterRule", "DrawReplaceRule", "TurnFilterRule", "SnapshotRule"]
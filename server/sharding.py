@@ -0,0 +1,177 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+
+def room_hash(room: str):  # stable between processes and restarts, unlike hash()
+    return zlib.crc32(room.encode())
+
+
+def ring_hash(key: str):  # crc32 clusters on similar names, which skews the ring
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class ShardMap:  # which of `count` processes on this machine owns a room
+    def __init__(self, index: int, count: int, base_port: int):
+        self.index = index
+        self.count = count
+        self.base_port = base_port  # shared by all shards, each also listens on base_port + 1 + index
+
+    def owner(self, room: str):
+        return room_hash(room) % self.count
+
+    def owns(self, room: str):
+        return self.owner(room) == self.index
+
+    def port(self, shard: int):
+        return self.base_port + 1 + shard
+
+    def redirect(self, room: str):  # where a client asking for room should go instead
+        return {"port": self.port(self.owner(room))}
+
+    def listen(self, port):  # (port, reuse_port) to serve on
+        # every shard takes connections on the shared port, the kernel spreads them, owners are told apart on accept
+        return [(port, True), (self.port(self.index), False)]
+
+    async def claim(self, room: str):  # None if room is opened here, otherwise where its clients go instead
+        return None if self.owns(room) else self.redirect(room)
+
+    def keep(self, room: str):
+        ...
+
+    async def release(self, room: str):
+        ...
+
+    async def maintain(self):
+        ...
+
+
+class HashRing:  # consistent hashing, adding or removing one of N nodes moves about 1/N of the rooms
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self.nodes = sorted(set(nodes))
+        self.points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self.keys = [h for h, _ in self.points]
+
+    def node(self, room: str):
+        if not self.points:
+            return None
+
+        i = bisect.bisect(self.keys, ring_hash(room)) % len(self.points)
+        return self.points[i][1]
+
+
+class StaticRegistry:  # a fixed list of nodes, e.g. from the config
+    def __init__(self, nodes):
+        self.fixed = list(nodes)
+
+    async def heartbeat(self, node: str, rooms=()):
+        ...
+
+    async def nodes(self):
+        return self.fixed
+
+    async def claim(self, room: str, node: str):  # the nodes never change, so neither does the owner of a room
+        return node
+
+    async def release(self, room: str, node: str):
+        ...
+
+
+class BrokerRegistry:  # nodes announce themselves to a broker, see server.registry
+    def __init__(self, host: str, port: int, ttl=15):
+        self.host = host
+        self.port = port
+        self.ttl = ttl  # a node that misses its heartbeats for this long is dropped
+
+    async def request(self, msg):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write((json.dumps(msg) + "\n").encode())
+            await writer.drain()
+            return json.loads(await reader.readline())
+        finally:
+            writer.close()
+
+    async def heartbeat(self, node: str, rooms=()):
+        await self.request({"op": "register", "node": node, "ttl": self.ttl, "rooms": list(rooms)})
+
+    async def nodes(self):
+        return (await self.request({"op": "nodes"}))["nodes"]
+
+    async def claim(self, room: str, node: str):  # the node holding room, node itself unless another live one does
+        return (await self.request({"op": "claim", "room": room, "node": node}))["node"]
+
+    async def release(self, room: str, node: str):
+        await self.request({"op": "release", "room": room, "node": node})
+
+
+class NodePlacement:  # which of the nodes known to the registry owns a room
+    def __init__(self, node: str, registry, interval=5):
+        self.node = node  # host:port, as clients reach it
+        self.registry = registry
+        self.interval = interval
+
+        self.ring = HashRing([node])
+        self.updated = 0
+
+        # rooms open here, also those whose owner changed since: their owner sends their clients here, see claim
+        self.rooms = set()
+
+    def owner(self, room: str):
+        return self.ring.node(room)
+
+    def owns(self, room: str):
+        return self.owner(room) == self.node
+
+    def redirect(self, room: str, node: str = None):
+        host, port = (node or self.owner(room)).rsplit(":", 1)
+        return {"host": host, "port": int(port)}
+
+    def listen(self, port):
+        return [(port, False)]
+
+    async def claim(self, room: str):  # None if room is opened here, otherwise where its clients go instead
+        if not self.owns(room):
+            return self.redirect(room)
+
+        holder = await self.registry.claim(room, self.node)  # still open on the node that owned it before
+        if holder != self.node:
+            return self.redirect(room, holder)
+
+        self.rooms.add(room)
+        return None
+
+    def keep(self, room: str):  # open here without a claim, e.g. restored, claimed again with the next heartbeat
+        self.rooms.add(room)
+
+    async def release(self, room: str):
+        self.rooms.discard(room)
+        await self.registry.release(room, self.node)
+
+    async def refresh(self):
+        await self.registry.heartbeat(self.node, sorted(self.rooms))
+        nodes = await self.registry.nodes()
+
+        if self.node not in nodes:
+            nodes = nodes + [self.node]
+        if sorted(nodes) != self.ring.nodes:
+            self.ring = HashRing(nodes)
+
+        self.updated = time.time()
+
+    async def maintain(self):
+        while True:
+            try:
+                await self.refresh()
+            except OSError:
+                logging.warning("room registry unreachable, keeping the last known nodes")
+
+            await asyncio.sleep(self.interval)
+
+
+__all__ = ["room_hash", "ring_hash", "ShardMap", "HashRing", "StaticRegistry", "BrokerRegistry", "NodePlacement"]
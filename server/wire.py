@@ -0,0 +1,74 @@
+import json
+import struct
+
+from typing import List
+
+from structures.colours import *
+
+
+class JsonCodec:  # the default, what every client understands
+    name = "json"
+
+    def handshake(self):
+        return None
+
+    def encode(self, messages):
+        if len(messages) == 1:
+            return json.dumps(messages[0])
+        else:
+            return json.dumps(messages)
+
+
+class BinaryCodec:
+    # records: effect code byte, then
+    #   draw_piece:     square byte (x << 4 | y), shape code, colour code
+    #   overlay:        square byte, text code, colour code
+    #   board_version:  uint32
+    #   seq:            uint32
+    #   anything else:  uint32 length, utf-8 json of [effect, args]
+    name = "binary"
+
+    effects = {"draw_piece": 1, "overlay": 2, "board_version": 3, "seq": 4, "json": 255}
+
+    def __init__(self, strings: List[str]):
+        self.strings = list(strings)[:255]
+        self.codes = {s: i for i, s in enumerate(self.strings)}
+
+    def handshake(self):  # sent once, as json, before the first binary frame
+        return json.dumps(("codes", {"effects": self.effects, "strings": self.strings}))
+
+    @staticmethod
+    def square(pos):
+        x, y = pos
+        if 0 <= x < 16 and 0 <= y < 16:
+            return x << 4 | y
+
+    def record(self, effect, args):
+        if effect in ["draw_piece", "overlay"]:
+            pos, a, b = args
+            sq = self.square(pos)
+
+            if sq is not None and a in self.codes and b in self.codes:
+                return struct.pack("BBBB", self.effects[effect], sq, self.codes[a], self.codes[b])
+        elif effect in ["board_version", "seq"]:
+            return struct.pack(">BI", self.effects[effect], args)
+
+        raw = json.dumps((effect, args)).encode()
+        return struct.pack(">BI", self.effects["json"], len(raw)) + raw  # snapshots of large boards pass 64 kB
+
+    def encode(self, messages):
+        return b"".join(self.record(effect, args) for effect, args in messages)
+
+
+def codec_strings(draw_table):
+    return [""] + sorted(set(draw_table.values())) + sorted(set(HEXCOL.values())) + ["x", "#"]
+
+
+def make_codec(encoding, draw_table):
+    if encoding == "binary":
+        return BinaryCodec(codec_strings(draw_table))
+
+    return JsonCodec()
+
+
+__all__ = ["JsonCodec", "BinaryCodec", "codec_strings", "make_codec"]
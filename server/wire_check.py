@@ -0,0 +1,71 @@
+import json
+import struct
+import sys
+
+from server.gameserver import DRAW_TABLES
+from server.wire import *
+from structures.colours import *
+
+
+def decode_frame(codec: BinaryCodec, frame: bytes):  # as decodeFrame in menu/chess/game.js
+    names = {code: name for name, code in codec.effects.items()}
+    messages = []
+
+    k = 0
+    while k < len(frame):
+        name = names[frame[k]]
+
+        if name in ["draw_piece", "overlay"]:
+            square = frame[k + 1]
+            pos = [square >> 4, square & 15]
+            messages.append([name, [pos, codec.strings[frame[k + 2]], codec.strings[frame[k + 3]]]])
+            k += 4
+        elif name in ["board_version", "seq"]:
+            messages.append([name, struct.unpack_from(">I", frame, k + 1)[0]])
+            k += 5
+        else:
+            n = struct.unpack_from(">I", frame, k + 1)[0]
+            messages.append(json.loads(frame[k + 5:k + 5 + n].decode()))
+            k += 5 + n
+
+    return messages
+
+
+def sample_batches(draw_table):  # batches that take every kind of record, and every fallback to json
+    shape = sorted(draw_table.values())[0]
+
+    yield [("draw_piece", ((4, 6), shape, HEXCOL["w"]))]
+    yield [("draw_piece", ((4, 6), "", "")), ("overlay", ((0, 7), "#", HEXCOL["fog"])),
+           ("board_version", 2 ** 32 - 1), ("seq", 7)]
+    yield [("draw_piece", ((16, 0), shape, HEXCOL["w"]))]  # off the square byte
+    yield [("draw_piece", ((1, 1), "unknown.svg", HEXCOL["w"]))]  # not in the codes
+    yield [("status", "w turn"), ("legal_moves", {"moves": [((4, 6), [(4, 5), (4, 4)])], "strict": True})]
+
+    pieces = [((x, y), shape, HEXCOL["b"]) for x in range(64) for y in range(64)]  # past 64 kB in one record
+    yield [("snapshot", {"pieces": pieces, "overlays": [], "status": None}), ("seq", 8)]
+
+
+def check_codecs(variant: str):  # (what, equal) for every sample batch, through both codecs
+    draw_table = DRAW_TABLES[variant]
+    binary = make_codec("binary", draw_table)
+    plain = make_codec("json", draw_table)
+
+    for i, batch in enumerate(sample_batches(draw_table)):
+        expected = json.loads(json.dumps(batch))  # what the client sees, tuples turn into lists
+
+        decoded = decode_frame(binary, binary.encode(batch))
+        yield f"{variant} binary {i}", decoded == expected
+
+        decoded = json.loads(plain.encode(batch))
+        yield f"{variant} json {i}", (decoded if len(batch) > 1 else [decoded]) == expected
+
+
+if __name__ == "__main__":
+    failed = 0
+
+    for variant in DRAW_TABLES:
+        for what, equal in check_codecs(variant):
+            print(what, "ok" if equal else "differs", file=sys.stderr)
+            failed += not equal
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+from collections import deque
+
+
+class RoomWorker:  # the inbound queue of one room, run one call at a time in submission order
+    max_pending = 256  # clicks beyond this close their connection, see offer and Connection.run
+
+    def __init__(self, scheduler: "RoomScheduler" = None):
+        self.scheduler = scheduler  # None to run everything inline, as it is submitted
+
+        self.pending = deque()  # (fn, args, time queued)
+        self.lock = threading.Lock()
+        self.scheduled = False  # waiting in the scheduler or being run
+        self.spawned = set()  # futures of the coroutines still running on the loop
+
+        self.processed = 0
+        self.dropped = 0
+        self.lag = 0.0  # time the last call spent waiting
+        self.max_lag = 0.0
+
+    def submit(self, fn, *args):
+        if self.scheduler is None:
+            fn(*args)
+            return
+
+        with self.lock:
+            self.pending.append((fn, args, time.perf_counter()))
+
+            if self.scheduled:
+                return  # already on its way through the scheduler
+            self.scheduled = True
+
+        self.scheduler.ready(self)
+
+    def offer(self, fn, *args):  # submit, unless the room is already flooded
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+
+        self.submit(fn, *args)
+        return True
+
+    def defer(self, fn, *args):  # after everything already submitted, e.g. work in between turns
+        if self.scheduler is not None:
+            self.submit(fn, *args)
+
+    def spawn(self, coro):  # on the event loop, e.g. the async rules of one processing pass
+        if self.scheduler is None:
+            coro.close()
+            return
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.scheduler.loop)
+        self.spawned.add(future)
+        future.add_done_callback(self.report)
+
+    def cancel(self):  # the room is gone, e.g. a TimeoutRule would otherwise keep it alive until it expires
+        for future in list(self.spawned):
+            future.cancel()
+
+    def report(self, future):
+        self.spawned.discard(future)
+
+        if future.cancelled():
+            return
+
+        # the results of a gathered batch of async rules, or None from a single coroutine like TimeoutRule.expire
+        results = [future.exception()] if future.exception() else future.result() or []
+
+        for res in results:
+            if isinstance(res, Exception):
+                logging.error("async rule encountered unexpected state", exc_info=(type(res), res, res.__traceback__))
+
+    def run(self, time_slice):  # process until empty or out of time, True if there is more to do
+        end = time.perf_counter() + time_slice
+
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.scheduled = False
+                    return False
+
+                if time.perf_counter() >= end:
+                    return True
+
+                fn, args, queued = self.pending.popleft()
+
+            self.lag = time.perf_counter() - queued
+            self.max_lag = max(self.max_lag, self.lag)
+
+            try:
+                fn(*args)
+            except Exception:
+                logging.error("room worker encountered unexpected state", exc_info=sys.exc_info())
+
+            self.processed += 1
+
+    def depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {"depth": len(self.pending), "processed": self.processed, "dropped": self.dropped,
+                "lag": self.lag, "max_lag": self.max_lag}
+
+
+class RoomScheduler:  # round robin over the rooms with pending calls, each gets at most time_slice per turn
+    def __init__(self, loop, workers=0, time_slice=0.02):
+        self.loop = loop
+        self.time_slice = time_slice
+
+        self.queue = deque()  # rooms ready to run
+        self.cond = threading.Condition()
+        self.stopped = False
+
+        # without threads the rooms take turns on the event loop, in between socket i/o
+        self.threads = [threading.Thread(target=self.work, name=f"room-{i}", daemon=True) for i in range(workers)]
+        for th in self.threads:
+            th.start()
+
+    def ready(self, room: RoomWorker):
+        if not self.threads:
+            self.loop.call_soon_threadsafe(self.step, room)
+            return
+
+        with self.cond:
+            self.queue.append(room)
+            self.cond.notify()
+
+    def step(self, room: RoomWorker):
+        if room.run(self.time_slice):
+            self.loop.call_soon(self.step, room)  # to the back of the loop's queue, behind the other rooms
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+
+                if self.stopped:
+                    return
+                room = self.queue.popleft()
+
+            if room.run(self.time_slice):
+                with self.cond:
+                    self.queue.append(room)
+                    self.cond.notify()
+
+    def stop(self, timeout=5):  # the threads finish the slice they are in, e.g. before the server is restarted
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+        for th in self.threads:
+            th.join(timeout)
+
+    def stats(self):
+        return {"ready": len(self.queue), "workers": len(self.threads), "time_slice": self.time_slice}
+
+
+__all__ = ["RoomWorker", "RoomScheduler"]
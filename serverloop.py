@@ -1,12 +1,49 @@
 import json
+import multiprocessing
+import sys
 
 from server.gameserver import thread_loop
+from server.sharding import *
+from server.persistence import *
 
 
 with open("server_config.json") as f:
     config = json.load(f)
 
 port = config["port"]
+workers = config.get("workers", 0)  # 0 processes every room on the event loop
+shards = config.get("shards", 1)  # processes, each owning the rooms that hash to it
+
+host = config.get("host", "localhost")  # as clients reach this node
+registry = config.get("registry", None)  # host:port of a broker, or a list of nodes, to share rooms between nodes
+
+handoff = config.get("handoff", None)  # unix socket path, lets a new deploy take the rooms over from the running one
+takeover = "--takeover" in sys.argv
+
+rooms = config.get("rooms", None)  # directory of room snapshots and journals, rooms are rebuilt from it after a crash
+records = config.get("records", None)  # directory to record every game in
+hibernate = config.get("hibernate", None)  # seconds without players before a room is reduced to its state
 
 if __name__ == "__main__":
-    thread_loop(port)
+    if registry is not None:
+        if isinstance(registry, list):
+            registry = StaticRegistry(registry)
+        else:
+            registry_host, registry_port = registry.rsplit(":", 1)
+            registry = BrokerRegistry(registry_host, int(registry_port))
+
+        thread_loop(port, workers, NodePlacement(f"{host}:{port}", registry), handoff, takeover,
+                    rooms and RoomStore(rooms), records, hibernate)
+    elif shards > 1:
+        processes = [multiprocessing.Process(target=thread_loop, args=(port, workers, ShardMap(i, shards, port),
+                                                                       handoff and f"{handoff}.{i}", takeover,
+                                                                       rooms and RoomStore(f"{rooms}/{i}"), records,
+                                                                       hibernate))
+                     for i in range(shards)]
+
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        thread_loop(port, workers, None, handoff, takeover, rooms and RoomStore(rooms), records, hibernate)
@@ -0,0 +1,185 @@
+import inspect
+import types
+
+from rules.rules import *
+from structures.structures import *
+
+
+_MODULES = {}  # (key, signature) -> generated module, shared by every ruleset with the same layout
+
+
+def ruleset_layout(ruleset: Ruleset):
+    # the dispatch order of a ruleset, with every rule replaced by its position in `rules`
+    found = {i: rule for views in ruleset.watches.values() for _, i, rule in views}
+    order = sorted(found)
+    remap = {i: j for j, i in enumerate(order)}
+    rules = [found[i] for i in order]
+
+    def views(effect):
+        vs = ruleset.watches.get(effect, []) + ruleset.watches.get("all", [])
+        return tuple(sorted((prio, remap[i]) for prio, i, _ in vs))
+
+    signature = tuple((w, views(w)) for w in sorted(ruleset.watches) if w != "all")
+    signature += (("all", views(None)),)
+
+    coroutines = tuple(j for j, rule in enumerate(rules) if inspect.iscoroutinefunction(rule.process))
+
+    return rules, (coroutines, signature)
+
+
+def generate_source(layout):
+    coroutines, signature = layout
+    lines = ["def bind(rs, R):"]
+
+    n = 1 + max((j for _, vs in signature for _, j in vs), default=-1)
+    for j in range(n):
+        lines += [f"    p{j} = R[{j}].process"]
+
+    for k, (w, vs) in enumerate(signature):
+        lines += ["", f"    def on{k}(game, effect, args):", "        cons = []"]
+
+        prio2 = -1
+        for prio, j in vs:
+            if prio != prio2:
+                if prio2 != -1:
+                    lines += ["        if cons:", "            rs.process_all(cons)", "            cons = []"]
+                prio2 = prio
+
+            if j in coroutines:
+                lines += [f"        rs.awaiting.append(p{j}(game, effect, args))"]
+            else:
+                lines += [f"        res = p{j}(game, effect, args)", "        if res is not None:",
+                          "            cons += res"]
+
+        lines += ["        if cons:", "            rs.process_all(cons)"]
+
+    table = ", ".join(f"{w!r}: on{k}" for k, (w, _) in enumerate(signature) if w != "all")
+    lines += ["", f"    return {{{table}}}, on{len(signature) - 1}", ""]
+
+    return "\n".join(lines)
+
+
+def load_module(key, signature):
+    mod = _MODULES.get((key, signature))
+
+    if mod is None:
+        name = "compiled_ruleset_" + str(key)
+        mod = types.ModuleType(name)
+        mod.__source__ = generate_source(signature)
+        exec(compile(mod.__source__, "<" + name + ">", "exec"), mod.__dict__)
+
+        _MODULES[(key, signature)] = mod
+
+    return mod
+
+
+class CompiledRuleset:
+    def __init__(self, ruleset: Ruleset, key):
+        self.ruleset = ruleset
+        self.key = key
+
+        self.table = {}
+        self.fallback = None
+        self.stale = True
+
+    def rebind(self):
+        rules, signature = ruleset_layout(self.ruleset)
+        mod = load_module(self.key, signature)
+
+        self.table, self.fallback = mod.bind(self.ruleset, rules)
+        self.stale = False
+
+    def __call__(self, effect, args):
+        if self.stale:
+            self.rebind()
+
+        self.table.get(effect, self.fallback)(self.ruleset.game, effect, args)
+
+
+def compile_ruleset(ruleset: Ruleset, key):
+    # unroll the (watch, priority) dispatch of `ruleset` into straight-line calls, rebinding lazily on changes
+    ruleset.compiled = CompiledRuleset(ruleset, key)
+    ruleset.compiled.rebind()
+
+    return ruleset.compiled
+
+
+def decompile_ruleset(ruleset: Ruleset):
+    ruleset.compiled = None
+
+
+class TraceRule(Rule):
+    def __init__(self):
+        Rule.__init__(self)
+
+        self.trace = []
+
+    def process(self, game, effect, args):
+        self.trace.append((effect, repr(args)))
+
+
+def record_inputs(records):
+    # the client input (effect, arg, player) behind the records of read_record: the first move of every turn is
+    # touched, a piece created on the square moved to is a promotion, one created without a move is a drop
+    turns = {}
+    for record in records:
+        if record[0] != "p":
+            turns.setdefault(record[1], []).append(record)
+
+    inputs = []
+    for turn_records in turns.values():
+        move = next((record for record in turn_records if record[0] == "m"), None)
+
+        if move is not None:
+            _, _, start, end = move
+            inputs += [("touch", tuple(start), None), ("touch", tuple(end), None)]  # by whoever's turn it is
+
+        for record in turn_records:
+            if record[0] == "c":
+                _, _, pos, col, shape = record
+
+                if move is None:
+                    inputs.append(("touch", tuple(pos), col))
+                elif tuple(pos) != tuple(move[3]):
+                    continue
+
+                inputs.append(("readstring", shape, col))  # the turn is locked while a prompt is open
+
+    return inputs
+
+
+def replay_trace(setup, records, compiled):
+    game = setup()
+    ruleset = game.ruleset
+    ruleset.debug = False
+
+    if not compiled:
+        decompile_ruleset(ruleset)
+    elif ruleset.compiled is None:
+        compile_ruleset(ruleset, "replay")
+
+    tracer = TraceRule()
+    ruleset.add_rule(tracer, 0)
+
+    for effect, arg, player in record_inputs(records):
+        ruleset.process(effect, (arg, player or game.get_turn()))
+
+    return tracer.trace
+
+
+def replay_equivalence(setup, records):
+    # replay a recorded game (the records of read_record) through an interpreted and a compiled copy of the same setup
+    interpreted = replay_trace(setup, records, compiled=False)
+    compiled = replay_trace(setup, records, compiled=True)
+
+    for i, (a, b) in enumerate(zip(interpreted, compiled)):
+        if a != b:
+            return False, (i, a, b)
+
+    if len(interpreted) != len(compiled):
+        return False, (min(len(interpreted), len(compiled)), None, None)
+
+    return True, None
+
+
+__all__ = ["CompiledRuleset", "compile_ruleset", "decompile_ruleset", "record_inputs", "replay_equivalence"]
@@ -1,4 +1,6 @@
+import asyncio
 import bisect
+import inspect
 import threading
 
 import tkinter as tk
@@ -27,6 +29,17 @@ class Ruleset:
         self.rules = {}
         self.watches = {"all": []}
         self.lock = threading.RLock()
+        self.compiled = None
+
+        self.coalescible = set()
+        self.deferred = []
+        self.depth = 0
+
+        self.flush_hooks = []  # called after every outermost process, e.g. to send buffered output
+        self.awaiting = []  # coroutines of async rules, awaited together after the outermost process
+
+        self.defer = None  # set by whatever drives the ruleset, runs a callable after the current event
+        self.spawn = None  # likewise, runs a coroutine on an event loop
 
         self.debug = True
 
@@ -44,19 +57,56 @@ class Ruleset:
             l.insert(bisect.bisect(l, tup), tup)
 
         self.size += 1
+        self.invalidate()
 
     def add_all(self, rules, prio=1):
         for rule in rules:
             self.add_rule(rule, prio=prio)
 
     def remove_rule(self, rule):
-        for k in self.rules:
-            if rule in self.rules[k]:
-                self.rules[k].remove(rule)
+        with self.lock:
+            for k in self.rules:
+                if rule in self.rules[k]:
+                    self.rules[k].remove(rule)
 
-        for w in rule.watch:
-            if rule in self.watches.get(w, []):
-                self.watches[w].remove(rule)
+            for w in rule.watch:  # entries are (prio, size, rule)
+                l = self.watches.get(w, [])
+                l[:] = [tup for tup in l if tup[2] is not rule]
+
+            self.invalidate()
+
+    def rewatch(self, rule, watch):  # keeps the priority and insertion order of rule
+        with self.lock:
+            entries = [(w, tup) for w, l in self.watches.items() for tup in l if tup[2] is rule]
+
+            for w, tup in entries:
+                self.watches[w].remove(tup)
+
+            rule.watch = watch
+
+            for key in {tup[:2] for _, tup in entries}:
+                for w in watch:
+                    l = self.watches.setdefault(w, [])
+
+                    tup = (*key, rule)
+
+                    l.insert(bisect.bisect(l, tup), tup)
+
+            self.invalidate()
+
+    def add_flush_hook(self, hook):
+        self.flush_hooks.append(hook)
+
+    def remove_flush_hook(self, hook):
+        if hook in self.flush_hooks:
+            self.flush_hooks.remove(hook)
+
+    def coalesce(self, effects):  # deliver these once, at the end of the outermost process
+        self.coalescible.update(effects)
+
+    def invalidate(self):
+        if self.compiled is not None:
+            self.compiled.stale = True
 
     def process_all(self, elist):
         try:
@@ -67,12 +117,50 @@ class Ruleset:
 
     def process(self, effect, args):
         with self.lock:
-            self._process(effect, args)
+            if self.depth and effect in self.coalescible:
+                if (effect, args) not in self.deferred:
+                    self.deferred.append((effect, args))
+                return
+
+            self.depth += 1
+            try:
+                self._process(effect, args)
+
+                if self.depth == 1:
+                    while self.deferred:
+                        self._process(*self.deferred.pop(0))
+            finally:
+                self.depth -= 1
+
+                if not self.depth:
+                    self.deferred = []
+
+                    for hook in list(self.flush_hooks):
+                        hook()
+
+                    batch, self.awaiting = self.awaiting, []
+                    if batch:
+                        self.run_async(batch)
+
+    def run_async(self, batch):
+        if self.spawn is None:  # nothing to run them on, e.g. outside the server
+            for coro in batch:
+                coro.close()
+            return
+
+        async def gather():
+            return await asyncio.gather(*batch, return_exceptions=True)
+
+        self.spawn(gather())
 
     def _process(self, effect, args):
         if self.debug:
             print(effect, args)
 
+        if self.compiled is not None:
+            self.compiled(effect, args)
+            return
+
         views = self.watches.get(effect, []) + self.watches.get("all", [])
         views.sort()
 
@@ -87,7 +175,9 @@ class Ruleset:
 
             res = rule.process(self.game, effect, args)
 
-            if res is not None:
+            if inspect.iscoroutine(res):  # async rules have no consequences, see run_async
+                self.awaiting.append(res)
+            elif res is not None:
                 res = list(res)
                 consequences += res
 
@@ -0,0 +1,264 @@
+import ast
+import inspect
+import textwrap
+
+from rules.rules import *
+from structures.structures import *
+
+
+EXTERNAL_EFFECTS = ["init", "create_piece", "touch", "readstring", "connect", "disconnect", "exit"]
+
+ANY = None  # stands for "every effect" wherever a set of effects is expected
+
+
+def _process_ast(rule):
+    try:
+        source = inspect.getsource(type(rule).process)
+    except (OSError, TypeError):
+        return None
+
+    tree = ast.parse(textwrap.dedent(source))
+    return tree.body[0]
+
+
+class _Resolver:
+    def __init__(self, rule, func):
+        self.rule = rule
+        self.assigns = {}
+
+        for node in ast.walk(func):
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                self.assigns.setdefault(node.targets[0].id, []).append(node.value)
+
+    def resolve(self, node, depth=0):  # set of strings node may evaluate to, or ANY
+        if depth > 4:
+            return ANY
+
+        if isinstance(node, ast.Constant):
+            return {node.value} if isinstance(node.value, str) else set()
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            out = set()
+            for elt in node.elts:
+                res = self.resolve(elt, depth + 1)
+                if res is ANY:
+                    return ANY
+                out |= res
+            return out
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "self":
+            return self.value(getattr(self.rule, node.attr, None))
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Attribute):
+            container = self.resolve_object(node.value)
+            if isinstance(container, dict):
+                return self.value(list(container.values()))
+        if isinstance(node, ast.Name) and node.id in self.assigns:
+            out = set()
+            for value in self.assigns[node.id]:
+                res = self.resolve(value, depth + 1)
+                if res is ANY:
+                    return ANY
+                out |= res
+            return out
+
+        return ANY
+
+    def resolve_object(self, node):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "self":
+            return getattr(self.rule, node.attr, None)
+
+    @staticmethod
+    def value(v):
+        if isinstance(v, str):
+            return {v}
+        if isinstance(v, (list, tuple, set)) and all(isinstance(x, str) for x in v):
+            return set(v)
+        return ANY
+
+
+def _union(a, b):
+    if a is ANY or b is ANY:
+        return ANY
+    return a | b
+
+
+def infer_emits(rule):
+    if isinstance(rule, AnyRule):
+        out = set()
+        for sub in rule.rules:
+            out = _union(out, declared_emits(sub))
+        return out
+
+    func = _process_ast(rule)
+    if func is None:
+        return ANY
+
+    resolver = _Resolver(rule, func)
+    out = set()
+
+    def effect_tuple(node):
+        nonlocal out
+        if isinstance(node, ast.Tuple) and len(node.elts) == 2:
+            head = node.elts[0]
+            if isinstance(head, ast.Name) and head.id not in resolver.assigns:
+                return  # e.g. a list of (start, end) pairs, not an effect
+
+            out = _union(out, resolver.resolve(head))
+
+    for node in ast.walk(func):
+        if isinstance(node, ast.List):
+            for elt in node.elts:
+                effect_tuple(elt)
+        elif isinstance(node, ast.Yield):
+            effect_tuple(node.value)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "process":
+            if node.args:  # effects injected around the return value, e.g. game.process("stop", ())
+                out = _union(out, resolver.resolve(node.args[0]))
+
+    return out
+
+
+def infer_consumes(rule):
+    if isinstance(rule, AnyRule):
+        out = set()
+        for sub in rule.rules:
+            out = _union(out, declared_consumes(sub))
+        return out
+
+    func = _process_ast(rule)
+    if func is None:
+        return ANY
+
+    body = [stmt for stmt in func.body if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant))]
+    if not body or all(isinstance(stmt, ast.Pass) for stmt in body):
+        return set()
+
+    params = [a.arg for a in func.args.args]
+    if len(params) < 3:
+        return ANY
+    effect = params[2]
+
+    resolver = _Resolver(rule, func)
+
+    # only a body that is entirely guarded by comparisons against effect counts as narrow
+    out = set()
+    for stmt in body:
+        if not isinstance(stmt, ast.If):
+            return ANY
+
+        test = stmt.test
+        if not (isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == effect
+                and len(test.ops) == 1 and isinstance(test.ops[0], (ast.Eq, ast.In))):
+            return ANY
+
+        out = _union(out, resolver.resolve(test.comparators[0]))
+        if out is ANY:
+            return ANY
+
+        if stmt.orelse:
+            if len(stmt.orelse) != 1 or not isinstance(stmt.orelse[0], ast.If):
+                return ANY
+            body += stmt.orelse
+
+    return out
+
+
+def declared_emits(rule):
+    if rule.emits is not None:
+        return set(rule.emits)
+    return infer_emits(rule)
+
+
+def declared_consumes(rule):
+    if rule.consumes is not None:
+        return set(rule.consumes)
+    if "all" not in rule.watch:
+        return set(rule.watch)
+    return infer_consumes(rule)
+
+
+class EffectGraph:
+    def __init__(self, ruleset: Ruleset, external=None):
+        self.ruleset = ruleset
+        self.external = set(EXTERNAL_EFFECTS if external is None else external)
+
+        found = {i: rule for views in ruleset.watches.values() for _, i, rule in views}
+        self.rules = [found[i] for i in sorted(found)]
+
+        self.consumes = {id(rule): declared_consumes(rule) for rule in self.rules}
+        self.emits = {id(rule): declared_emits(rule) for rule in self.rules}
+
+    def watched(self):
+        return {w for rule in self.rules for w in rule.watch if w != "all"}
+
+    def emitted(self):
+        out = set(self.external)
+        for rule in self.rules:
+            out = _union(out, self.emits[id(rule)])
+        return out
+
+    def consumed(self):
+        out = set()
+        for rule in self.rules:
+            out = _union(out, self.consumes[id(rule)])
+        return out
+
+    def reachable(self):  # (effects, rules) reachable from the external effects
+        effects = set(self.external)
+        rules = []
+
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.rules:
+                if rule in rules:
+                    continue
+
+                consumes = self.consumes[id(rule)]
+                if consumes is ANY or consumes & effects:
+                    rules.append(rule)
+                    changed = True
+
+                    emits = self.emits[id(rule)]
+                    effects = _union(effects, self.watched() if emits is ANY else emits)
+
+        return effects, rules
+
+    def dead_effects(self):  # emitted, but nobody looks at them
+        emitted, consumed = self.emitted(), self.consumed()
+        if emitted is ANY or consumed is ANY:
+            return set()
+
+        return emitted - consumed
+
+    def unreachable_rules(self):
+        _, rules = self.reachable()
+        return [rule for rule in self.rules if rule not in rules]
+
+    def needlessly_global(self):
+        return [rule for rule in self.rules if "all" in rule.watch and self.consumes[id(rule)] is not ANY]
+
+    def report(self):
+        lines = []
+
+        for effect in sorted(self.dead_effects()):
+            lines += [f"dead effect: {effect}"]
+        for rule in self.unreachable_rules():
+            lines += [f"unreachable rule: {type(rule).__name__} (consumes {sorted(self.consumes[id(rule)])})"]
+        for rule in self.needlessly_global():
+            lines += [f"needlessly global rule: {type(rule).__name__} (consumes {sorted(self.consumes[id(rule)])})"]
+
+        return lines
+
+
+def narrow_watches(ruleset: Ruleset):
+    # only rules that declare both sides of their flow are narrowed, inference is used for reporting only
+    narrowed = []
+
+    for rule in EffectGraph(ruleset).needlessly_global():
+        if rule.consumes is not None and rule.emits is not None:
+            ruleset.rewatch(rule, list(rule.consumes))
+            narrowed.append(rule)
+
+    return narrowed
+
+
+__all__ = ["EXTERNAL_EFFECTS", "EffectGraph", "narrow_watches", "declared_emits", "declared_consumes"]